@@ -2,6 +2,7 @@
 # itforprof.com by Konstantin Tyutyunnik
 
 import json
+import urllib.parse
 import urllib.request
 import urllib.error
 import os
@@ -13,7 +14,27 @@ import re
 import glob
 import ipaddress
 import subprocess
-from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+import bisect
+import codecs
+import contextlib
+import gzip
+import heapq
+import http.client
+import io
+import itertools
+import shutil
+import socket
+import ssl
+import threading
+import zlib
+from array import array
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:  # optional: the pure-Python engine is used instead
+    np = None
 
 # Configuration
 OUTPUT_TXT = os.environ.get("OUTPUT_TXT", "/var/lib/bird/prefixes.txt")
@@ -60,6 +81,11 @@ OWN_INFRA_CONF = os.environ.get("OWN_INFRA_CONF", "/etc/bird/own-infra.conf")
 # that dedup would drop). See validate_classes_against_peers().
 PEERS_DIR = os.environ.get("PEERS_DIR", "/etc/bird/peers.d")
 
+# --split-output: one `protocol static bgp_prefixes_<part>` per file in this
+# directory, pulled into bird.conf with a glob include, so a reconfigure only
+# restarts the protocols whose file changed.
+PREFIXES_DIR = os.environ.get("PREFIXES_DIR", "/etc/bird/prefixes.d")
+
 # Built-in export filters from bird.conf and the inclusive community-suffix
 # range each one accepts. Used only to verify --aggregate-classes is safe; an
 # unknown filter name fails closed because we cannot prove its range.
@@ -74,16 +100,44 @@ FILTER_RANGES: Dict[str, Tuple[int, int]] = {
 # coarse export-filter accept-range: RU 100-199, blocked+services 200-399).
 # Override with --aggregate-classes, disable with --no-aggregate.
 DEFAULT_AGGREGATE_CLASSES = "100-199,200-399"
+# --route-budget never aggregates into a supernet shorter than this.
+BUDGET_MIN_PREFIXLEN = 8
 
 CACHE_DIR = os.environ.get("CACHE_DIR", "/var/lib/bird/prefix-cache")
 CACHE_TTL = int(os.environ.get("CACHE_TTL", "21600"))  # 6 hours
 STALE_CACHE_MAX_AGE = int(os.environ.get("STALE_CACHE_MAX_AGE", "604800"))  # 7 days
+# Disk budget for CACHE_DIR in bytes (0 = unlimited); least recently used
+# entries are evicted after each run. CACHE_COMPRESS=1 stores bodies gzipped.
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", "0"))
+CACHE_COMPRESS = os.environ.get("CACHE_COMPRESS", "0") == "1"
 USER_AGENT = "Mozilla/5.0 (compatible; BIRD2-BGP-Prefix-Updater/3.4; +itforprof.com)"
 MAX_RETRIES = 3
 RETRY_DELAY = 10  # seconds
+# Concurrent fetch stage: total parallel downloads, and how many of them may
+# hit the same upstream host at once (a dozen sources live on stat.ripe.net).
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "8"))
+FETCH_PER_HOST = int(os.environ.get("FETCH_PER_HOST", "4"))
+# Wall-clock budget (seconds) for the fetch stage of a run; 0 (the default)
+# disables it. Downloads still unfinished at the deadline fall back to the
+# stale cache or, failing that, to the per-source FALLBACK restore.
+RUN_DEADLINE = int(os.environ.get("RUN_DEADLINE", "0"))
+# Circuit breaker: a source that failed BREAKER_THRESHOLD runs in a row is not
+# downloaded again for BREAKER_COOLDOWN seconds (cache/FALLBACK only), then
+# gets a single probe attempt. BREAKER_THRESHOLD=0 disables the breaker.
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", "3"))
+BREAKER_COOLDOWN = int(os.environ.get("BREAKER_COOLDOWN", "3600"))
+# Seconds to wait for a source mirror before also asking the next one.
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", "3"))
+HEALTH_SAMPLES = 20  # latency samples kept per source
+MAX_REDIRECTS = 5
+DOWNLOAD_CHUNK = 64 * 1024  # bytes streamed from a response per read
 
 # Data Sources (Verified working URLs)
 Source = Dict[str, Any]
+# A route prefix as (network_int, prefixlen). The feed itself is a RouteTable
+# of prefixes with community bitmasks (see CommunityRegistry), built once from
+# the sources and carried through every stage; only the writer renders text.
+RouteKey = Tuple[int, int]
 
 SOURCES: List[Source] = [
     # --- RU resources (100..199) ---
@@ -108,7 +162,8 @@ SOURCES: List[Source] = [
     },
     {
         "name": "rkn_subnets",
-        "urls": [
+        # Two mirrors of the same list: one answer is enough (hedged).
+        "mirrors": [
             "https://antifilter.network/download/subnet.lst",
             "https://antifilter.download/list/subnet.lst",
         ],
@@ -252,118 +307,607 @@ SOURCES: List[Source] = [
 ]
 
 
+# --- Integer prefix codec ---
+# Dotted-quad and CIDR text <-> (network_int, prefixlen) without building
+# ipaddress objects, which dominated CPU at several per prefix. Accepts exactly
+# what ipaddress.IPv4Network(text, strict=False) accepts: octet lookup in a
+# table of canonical spellings rejects empty, non-ASCII-digit, over-long,
+# zero-padded and >255 octets in one step. Rare forms (netmask / hostmask
+# suffixes, zero-padded prefix lengths) defer to ipaddress itself.
+_OCTETS: Dict[str, int] = {str(i): i for i in range(256)}
+_PREFIXLENS: Dict[str, int] = {str(i): i for i in range(33)}
+
+
+def parse_ipv4(text: str) -> int:
+    """Dotted-quad IPv4 address -> int; ValueError if ipaddress would reject it."""
+    try:
+        a, b, c, d = text.split(".")
+        return _OCTETS[a] << 24 | _OCTETS[b] << 16 | _OCTETS[c] << 8 | _OCTETS[d]
+    except (KeyError, ValueError):
+        raise ValueError(f"Invalid IPv4 address: {text!r}") from None
+
+
+def parse_cidr(text: str) -> Tuple[int, int]:
+    """'a.b.c.d/len' (or a bare address, as /32) -> (network_int, prefixlen),
+    host bits cleared as with strict=False; ValueError if invalid."""
+    addr, sep, length = text.partition("/")
+    if not sep:
+        return parse_ipv4(addr), 32
+    plen = _PREFIXLENS.get(length)
+    if plen is None:
+        network = ipaddress.IPv4Network(text, strict=False)
+        return int(network.network_address), network.prefixlen
+    return parse_ipv4(addr) & (0xFFFFFFFF ^ (0xFFFFFFFF >> plen)), plen
+
+
+def format_ipv4(n: int) -> str:
+    return f"{n >> 24}.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+
+def format_cidr(net: int, plen: int) -> str:
+    return f"{net >> 24}.{(net >> 16) & 255}.{(net >> 8) & 255}.{net & 255}/{plen}"
+
+
 def ip_to_int(ip: str) -> int:
-    return int(ipaddress.IPv4Address(ip))
+    return parse_ipv4(ip)
 
 
 def int_to_ip(n: int) -> str:
-    return str(ipaddress.IPv4Address(n))
+    if not 0 <= n <= 0xFFFFFFFF:
+        raise ValueError(f"Invalid IPv4 address: {n!r}")
+    return format_ipv4(n)
 
 
 def cidr_to_range(cidr: str) -> Tuple[int, int]:
-    if "/" not in cidr:
-        cidr = f"{cidr}/32"
-    network = ipaddress.IPv4Network(cidr, strict=False)
-    return int(network.network_address), int(network.broadcast_address)
+    net, plen = parse_cidr(cidr)
+    return net, net | (0xFFFFFFFF >> plen)
+
+
+def range_to_prefixes(start: int, end: int) -> List[Tuple[int, int]]:
+    """Minimal (network_int, prefixlen) cover of start..end, in address order
+    (what ipaddress.summarize_address_range yields, without the objects).
+
+    Each step takes the largest block that is both aligned at `start` (its
+    lowest set bit) and fits in what is left (bit length of the remainder).
+    """
+    if not 0 <= start <= end <= 0xFFFFFFFF:
+        raise ValueError(f"Invalid IPv4 range: {start}-{end}")
+    prefixes: List[Tuple[int, int]] = []
+    while start <= end:
+        bits = (end - start + 1).bit_length() - 1
+        if start:
+            bits = min(bits, (start & -start).bit_length() - 1)
+        prefixes.append((start, 32 - bits))
+        start += 1 << bits
+    return prefixes
 
 
 def range_to_cidrs(start: int, end: int) -> List[str]:
-    return [
-        str(network)
-        for network in ipaddress.summarize_address_range(
-            ipaddress.IPv4Address(start), ipaddress.IPv4Address(end)
-        )
-    ]
+    return [format_cidr(net, plen) for net, plen in range_to_prefixes(start, end)]
 
 
-def collapse_networks(networks: List[str]) -> List[str]:
-    if not networks:
-        return []
-    ranges: List[Tuple[int, int]] = []
-    for n in networks:
+def iter_ranges(items: Iterable[str]) -> Iterator[Tuple[int, int]]:
+    """Normalize raw source items into (start, end) integer ranges, lazily.
+
+    Accepts CIDRs, bare IPs (as /32) and 'first-last' ranges; anything that
+    does not parse (or a range with first > last) is skipped, exactly as the
+    CIDR validation in the pipeline always did.
+    """
+    for item in items:
+        item = item.strip()
+        if not item:
+            continue
         try:
-            ranges.append(cidr_to_range(n))
-        except Exception:
+            if "-" in item:
+                parts = [x.strip() for x in item.split("-")]
+                if len(parts) != 2:
+                    continue
+                start, end = parse_ipv4(parts[0]), parse_ipv4(parts[1])
+                if start <= end:
+                    yield start, end
+            else:
+                net, plen = parse_cidr(item)
+                yield net, net | (0xFFFFFFFF >> plen)
+        except ValueError:
             continue
-    if not ranges:
+
+
+# Below this many ranges the NumPy engine's setup costs more than it saves.
+NUMPY_MIN_RANGES = 2048
+
+
+def _collapse_keys_numpy(keys: array) -> List[Tuple[int, int]]:
+    """NumPy engine for collapse_ranges(): sort the packed keys, carry a
+    running maximum of the ends, and start a new block wherever a start
+    clears the running end by more than one address."""
+    ordered = np.sort(np.frombuffer(keys, dtype=np.uint64))
+    starts = (ordered >> np.uint64(32)).astype(np.int64)
+    run_end = np.maximum.accumulate((ordered & np.uint64(0xFFFFFFFF)).astype(np.int64))
+    first = np.flatnonzero(np.concatenate(([True], starts[1:] > run_end[:-1] + 1)))
+    last = np.append(first[1:] - 1, len(ordered) - 1)
+    return list(zip(starts[first].tolist(), run_end[last].tolist()))
+
+
+def _ranges_to_prefixes_numpy(ranges: Sequence[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """NumPy engine for ranges_to_prefixes(): peel the largest aligned block off
+    the front of every remaining range at once (at most 32 rounds), then put
+    the pieces back in address order."""
+    bounds = np.array(ranges, dtype=np.int64).reshape(-1, 2)
+    cur, end = bounds[:, 0].copy(), bounds[:, 1]
+    nets: List[Any] = []
+    sizes: List[Any] = []
+    while len(cur):
+        # log2 of the alignment of cur (32 for 0) and of the remaining length;
+        # frexp is exact on these integers where log2 could round.
+        align = np.frexp((cur & -cur).astype(np.float64))[1] - 1
+        align[cur == 0] = 32
+        fits = np.frexp((end - cur + 1).astype(np.float64))[1] - 1
+        bits = np.minimum(align, fits)
+        nets.append(cur)
+        sizes.append(bits)
+        cur = cur + (np.int64(1) << bits)
+        keep = cur <= end
+        cur, end = cur[keep], end[keep]
+    net = np.concatenate(nets)
+    plen = 32 - np.concatenate(sizes)
+    order = np.argsort(net, kind="stable")
+    return list(zip(net[order].tolist(), plen[order].tolist()))
+
+
+def ranges_to_prefixes(ranges: Sequence[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """(network_int, prefixlen) cover of sorted, disjoint (start, end) ranges,
+    in address order: range_to_prefixes() over each range, concatenated."""
+    if np is not None and len(ranges) >= NUMPY_MIN_RANGES:
+        return _ranges_to_prefixes_numpy(ranges)
+    return [p for start, end in ranges for p in range_to_prefixes(start, end)]
+
+
+def ranges_to_cidrs(ranges: Sequence[Tuple[int, int]]) -> List[str]:
+    return [format_cidr(net, plen) for net, plen in ranges_to_prefixes(ranges)]
+
+
+def collapse_ranges(ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Merge overlapping and adjacent (start, end) ranges into sorted blocks.
+
+    The input is consumed once into a flat array of packed 64-bit keys
+    (start << 32 | end, which sorts like the tuple) so a large source costs
+    8 bytes per range rather than a tuple of two ints. Large inputs are merged
+    with NumPy when it is installed (identical result).
+    """
+    keys = array("Q", ((start << 32) | end for start, end in ranges))
+    if not keys:
         return []
-    ranges.sort()
-    collapsed_ranges: List[Tuple[int, int]] = []
-    curr_start, curr_end = ranges[0]
-    for next_start, next_end in ranges[1:]:
+    if np is not None and len(keys) >= NUMPY_MIN_RANGES:
+        return _collapse_keys_numpy(keys)
+    ordered = sorted(keys)
+    del keys
+    collapsed: List[Tuple[int, int]] = []
+    curr_start, curr_end = ordered[0] >> 32, ordered[0] & 0xFFFFFFFF
+    for key in ordered:
+        next_start, next_end = key >> 32, key & 0xFFFFFFFF
         if next_start <= curr_end + 1:
             curr_end = max(curr_end, next_end)
         else:
-            collapsed_ranges.append((curr_start, curr_end))
+            collapsed.append((curr_start, curr_end))
             curr_start, curr_end = next_start, next_end
-    collapsed_ranges.append((curr_start, curr_end))
-    result: List[str] = []
-    for s, e in collapsed_ranges:
-        result.extend(range_to_cidrs(s, e))
-    return result
-
-
-def _community_class(c: int, classes: Sequence[Tuple[int, int]]) -> object:
-    """Map a community suffix to its aggregation class id: the (lo, hi) range
-    that contains it, or a unique singleton if no class does. Communities in
-    the same class are interchangeable for the dedup decision."""
-    for lo, hi in classes:
-        if lo <= c <= hi:
-            return (lo, hi)
-    return ("singleton", c)
-
-
-def dedup_covered_more_specifics(
-    all_routes: Dict[str, Set[int]],
-    classes: Sequence[Tuple[int, int]] = (),
-) -> int:
+    collapsed.append((curr_start, curr_end))
+    return collapsed
+
+
+def collapse_networks(networks: List[str]) -> List[str]:
+    ranges: List[Tuple[int, int]] = []
+    for n in networks:
+        try:
+            ranges.append(cidr_to_range(n))
+        except Exception:
+            continue
+    return ranges_to_cidrs(collapse_ranges(ranges))
+
+
+class CommunityRegistry:
+    """Bit assignment for community suffixes: suffix i-th in ascending order
+    is bit i, so a route's communities are one int, merging them is an OR and
+    decoding a mask yields the suffixes already sorted."""
+
+    __slots__ = ("suffixes", "bits")
+
+    def __init__(self, suffixes: Iterable[int]) -> None:
+        self.suffixes: List[int] = sorted(set(suffixes))
+        if len(self.suffixes) > RouteTable.MAX_COMMUNITIES:
+            raise ValueError(
+                f"{len(self.suffixes)} distinct community suffixes configured; "
+                f"at most {RouteTable.MAX_COMMUNITIES} are supported"
+            )
+        self.bits: Dict[int, int] = {c: 1 << i for i, c in enumerate(self.suffixes)}
+
+    @classmethod
+    def from_sources(cls, sources: Sequence[Source]) -> "CommunityRegistry":
+        return cls(src["community_suffix"] for src in sources)
+
+    def mask(self, suffixes: Iterable[int]) -> int:
+        """Mask of `suffixes`; suffixes without a bit (no such source) are
+        dropped."""
+        m = 0
+        for c in suffixes:
+            m |= self.bits.get(c, 0)
+        return m
+
+    def decode(self, mask: int) -> List[int]:
+        return [c for i, c in enumerate(self.suffixes) if mask >> i & 1]
+
+    def class_masks(self, classes: Sequence[Tuple[int, int]]) -> List[int]:
+        """One mask per (lo, hi) class: the bits of the suffixes it contains."""
+        return [self.mask(c for c in self.suffixes if lo <= c <= hi) for lo, hi in classes]
+
+
+class RouteTable:
+    """The feed as three parallel arrays: network (uint32), prefix length
+    (uint8) and community mask (uint64) — 13 bytes a route instead of a dict
+    entry, a key tuple and a set.
+
+    Inserts only append; duplicates are merged (masks OR-ed) and the table put
+    in (network, prefixlen) order lazily, the first time it is read, so bulk
+    inserts stay cheap. Iteration yields (network, prefixlen, mask) in order.
+    """
+
+    __slots__ = ("nets", "plens", "masks", "_compact")
+
+    MAX_COMMUNITIES = 64  # bits in a mask
+    MAGIC = b"BPU-ROUTES-1\n"
+
+    def __init__(self) -> None:
+        self.nets = array("I")
+        self.plens = array("B")
+        self.masks = array("Q")
+        self._compact = True
+
+    def add(self, net: int, plen: int, mask: int) -> None:
+        self.nets.append(net)
+        self.plens.append(plen)
+        self.masks.append(mask)
+        self._compact = False
+
+    def extend(self, prefixes: Sequence[RouteKey], mask: int) -> None:
+        """Bulk insert of `prefixes`, all with community `mask`."""
+        if not prefixes:
+            return
+        self.nets.extend(net for net, _ in prefixes)
+        self.plens.extend(plen for _, plen in prefixes)
+        self.masks.extend(itertools.repeat(mask, len(prefixes)))
+        self._compact = False
+
+    def _merge(self) -> None:
+        if self._compact:
+            return
+        nets, plens, masks = self.nets, self.plens, self.masks
+        # Sort row numbers by (network, prefixlen), packed into one int.
+        order = sorted((nets[i] << 6 | plens[i]) << 32 | i for i in range(len(nets)))
+        new_nets, new_plens, new_masks = array("I"), array("B"), array("Q")
+        prev = -1
+        for packed in order:
+            i = packed & 0xFFFFFFFF
+            key = packed >> 32
+            if key == prev:
+                new_masks[-1] |= masks[i]
+            else:
+                new_nets.append(nets[i])
+                new_plens.append(plens[i])
+                new_masks.append(masks[i])
+                prev = key
+        self.nets, self.plens, self.masks = new_nets, new_plens, new_masks
+        self._compact = True
+
+    def __len__(self) -> int:
+        self._merge()
+        return len(self.nets)
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int]]:
+        self._merge()
+        return zip(self.nets, self.plens, self.masks)
+
+    def retain(self, keep: Sequence[bool]) -> int:
+        """Keep only the routes whose flag (in iteration order) is true;
+        returns how many were removed."""
+        self._merge()
+        before = len(self.nets)
+        self.nets = array("I", itertools.compress(self.nets, keep))
+        self.plens = array("B", itertools.compress(self.plens, keep))
+        self.masks = array("Q", itertools.compress(self.masks, keep))
+        return before - len(self.nets)
+
+    def dump(self, f: Any) -> None:
+        """Write the table to binary file `f`: magic, count, then the three
+        arrays, little-endian."""
+        self._merge()
+        f.write(self.MAGIC + len(self.nets).to_bytes(4, "little"))
+        for arr in (self.nets, self.plens, self.masks):
+            if sys.byteorder != "little":
+                arr = array(arr.typecode, arr)
+                arr.byteswap()
+            arr.tofile(f)
+
+    @classmethod
+    def read(cls, f: Any, name: str) -> "RouteTable":
+        """Read a table written by dump() from `f`; ValueError if it is not
+        one (`name` labels the error)."""
+        table = cls()
+        if f.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise ValueError(f"{name}: not a route table")
+        count = int.from_bytes(f.read(4), "little")
+        try:
+            for arr in (table.nets, table.plens, table.masks):
+                arr.fromfile(f, count)
+                if sys.byteorder != "little":
+                    arr.byteswap()
+        except EOFError:
+            raise ValueError(f"{name}: truncated route table") from None
+        return table
+
+
+def covering_parents(keys: Iterable[RouteKey]) -> List[int]:
+    """For a sorted, duplicate-free run of prefixes (a RouteTable iterates in
+    that order), the index of each one's nearest covering prefix, -1 if none.
+
+    One pass with a stack of the currently open prefixes: in (network,
+    prefixlen) order a later prefix is inside an open one iff it starts no
+    later than that one ends, so everything ending before it is popped and
+    the top of the stack is its parent. O(n).
+    """
+    parents: List[int] = []
+    stack: List[int] = []  # indexes of the open prefixes, outermost first
+    ends: List[int] = []   # last address of each of them
+    prev = -1
+    for i, (net, plen) in enumerate(keys):
+        packed = net << 6 | plen
+        if packed <= prev:
+            raise ValueError("covering_parents() keys must be sorted and unique")
+        prev = packed
+        while ends and net > ends[-1]:
+            ends.pop()
+            stack.pop()
+        parents.append(stack[-1] if stack else -1)
+        stack.append(i)
+        ends.append(net | 0xFFFFFFFF >> plen)
+    return parents
+
+
+def class_closure(class_masks: Sequence[int]) -> Callable[[int], int]:
+    """Memoized map from a community mask to its class closure: every class
+    it touches widened to the whole class, plus its communities outside any
+    class as singletons. Two routes are interchangeable for every validated
+    filter iff their closures are equal."""
+    classed = 0
+    for cm in class_masks:
+        classed |= cm
+    closures: Dict[int, int] = {}
+
+    def closure(mask: int) -> int:
+        cl = closures.get(mask)
+        if cl is None:
+            cl = mask & ~classed
+            for cm in class_masks:
+                if mask & cm:
+                    cl |= cm
+            closures[mask] = cl
+        return cl
+
+    return closure
+
+
+def dedup_covered_more_specifics(all_routes: RouteTable, class_masks: Sequence[int] = ()) -> int:
     """Drop a prefix when a less-specific prefix in the same feed covers it AND
     carries a superset of its community *classes*.
 
     `collapse_networks` only dedups within a single source/community, so a /32
     from one list nested in a /24 from another survives. This removes those.
 
-    With the default empty `classes`, a route is dropped only when the covering
-    supernet has an exact superset of its communities — universally safe for any
-    export filter. Passing `classes` (community-suffix ranges that every export
-    filter accepts or rejects as a whole, e.g. [(100,199),(200,399)]) treats
-    communities within a range as equivalent, which is what unlocks real feed
-    reduction — but is sound ONLY if no peer filter splits a class. Callers that
-    pass `classes` MUST first call validate_classes_against_peers() (fail-closed).
+    With the default empty `class_masks`, a route is dropped only when the
+    covering supernet has an exact superset of its communities — universally
+    safe for any export filter. Passing `class_masks` (from
+    CommunityRegistry.class_masks() for community-suffix ranges that every
+    export filter accepts or rejects as a whole, e.g. [(100,199),(200,399)])
+    treats communities within a range as equivalent, which is what unlocks real
+    feed reduction — but is sound ONLY if no peer filter splits a class.
+    Callers that pass classes MUST first call validate_classes_against_peers()
+    (fail-closed).
 
     Mutates `all_routes` in place; returns the number of routes removed.
     """
-    def class_set(comms: Set[int]) -> frozenset:
-        return frozenset(_community_class(c, classes) for c in comms)
-
-    # Index networks by prefix length for O(prefixlen) supernet lookup.
-    by_len: Dict[int, Dict[int, frozenset]] = {}
-    parsed: Dict[str, ipaddress.IPv4Network] = {}
-    own_class: Dict[str, frozenset] = {}
-    for cidr, comms in all_routes.items():
-        net = ipaddress.IPv4Network(cidr)
-        parsed[cidr] = net
-        cs = class_set(comms)
-        own_class[cidr] = cs
-        by_len.setdefault(net.prefixlen, {})[int(net.network_address)] = cs
-    plens = sorted(by_len)
-
-    drop: List[str] = []
-    for cidr, net in parsed.items():
-        ip = int(net.network_address)
-        p_cls = own_class[cidr]
-        for pl in plens:
-            if pl >= net.prefixlen:
-                break  # only strictly less-specific prefixes can cover P
-            mask = (0xFFFFFFFF << (32 - pl)) & 0xFFFFFFFF
-            s_cls = by_len[pl].get(ip & mask)
-            if s_cls is not None and p_cls <= s_cls:
-                drop.append(cidr)
+    # P's classes are a subset of S's iff P's closure has no bit outside S's.
+    closure = class_closure(class_masks)
+
+    # In sorted order every route comes after its nearest covering route, so
+    # one pass carries down the union of its ancestors' closures. A class
+    # missing from that union rules every supernet out at once; otherwise the
+    # ancestor chain (a few routes deep) is checked for a single superset.
+    closures_by_row = [closure(comms) for _, _, comms in all_routes]
+    parents = covering_parents(zip(all_routes.nets, all_routes.plens))
+    count = len(closures_by_row)
+    above = [0] * count
+    keep = [True] * count
+    for i, parent in enumerate(parents):
+        if parent < 0:
+            continue
+        union = above[i] = above[parent] | closures_by_row[parent]
+        p_cls = closures_by_row[i]
+        if p_cls & ~union:
+            continue
+        while parent >= 0:
+            if not p_cls & ~closures_by_row[parent]:
+                keep[i] = False
                 break
+            parent = parents[parent]
+
+    return all_routes.retain(keep)
+
+
+def aggregate_siblings(all_routes: RouteTable, class_masks: Sequence[int] = ()) -> RouteTable:
+    """Merge sibling and adjacent routes of the same class closure into the
+    minimal CIDR cover of their union (two /24s -> one /23, and so on).
 
-    for cidr in drop:
-        del all_routes[cidr]
-    return len(drop)
+    The address space of each closure is unchanged; only its split into
+    prefixes is. Each resulting prefix carries the OR of the communities of
+    the routes it replaces, so a /23 built from a blocked_ip /24 and an
+    rkn_subnets /24 is tagged with both. Like dedup with classes, this is
+    sound only once validate_classes_against_peers() has passed: a filter
+    that splits a class could accept one half and not the other.
+
+    Returns a new table.
+    """
+    closure = class_closure(class_masks)
+    groups: Dict[int, List[Tuple[int, int, int]]] = {}
+    for net, plen, comms in all_routes:
+        groups.setdefault(closure(comms), []).append((net, net | 0xFFFFFFFF >> plen, comms))
+
+    merged = RouteTable()
+    for members in groups.values():
+        for net, plen, comms in _minimal_cover(members):
+            merged.add(net, plen, comms)
+    return merged
+
+
+def _minimal_cover(members: Sequence[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    """Minimal CIDR cover of (start, end, mask) members given in network
+    order, as (network, prefixlen, mask) with each prefix carrying the OR of
+    the masks of the members inside it. Every member lies inside exactly one
+    prefix of the cover (aligned blocks nest or are disjoint, and the cover
+    takes the largest block at each step), so one forward pass assigns them."""
+    cover: List[Tuple[int, int, int]] = []
+    prefixes = ranges_to_prefixes(collapse_ranges((start, end) for start, end, _ in members))
+    i = 0
+    for net, plen in prefixes:
+        last = net | 0xFFFFFFFF >> plen
+        comms = 0
+        while i < len(members) and members[i][0] <= last:
+            comms |= members[i][2]
+            i += 1
+        cover.append((net, plen, comms))
+    return cover
+
+
+def aggregate_to_budget(
+    all_routes: RouteTable,
+    class_mask: int,
+    budget: int,
+    own: "OwnInfraIndex",
+) -> Tuple[RouteTable, int]:
+    """Lossy aggregation of one class down to `budget` routes, for peers whose
+    max-prefix limit is below the full feed.
+
+    The routes carrying only communities of the class are first merged
+    losslessly (as aggregate_siblings does), then neighbours are greedily
+    replaced by their smallest common supernet, cheapest first: the cost of a
+    merge is the address space it adds that no route covered, per route it
+    saves. A supernet is never taken if it overlaps own infrastructure or is
+    shorter than /BUDGET_MIN_PREFIXLEN. Routes that also carry another class
+    count against the budget but are left alone, so the budget may not be
+    reachable; the caller compares the result with it.
+
+    Returns the new table and the number of addresses the class now covers
+    that none of its routes covered before (the over-coverage introduced).
+    """
+    members: List[Tuple[int, int, int]] = []
+    result = RouteTable()
+    for net, plen, comms in all_routes:
+        if comms and not comms & ~class_mask:
+            members.append((net, net | 0xFFFFFFFF >> plen, comms))
+        else:
+            result.add(net, plen, comms)
+    fixed = sum(1 for _, _, comms in result if comms & class_mask)
+    cover = _minimal_cover(members)
+
+    # Doubly linked list of the class's prefixes in network order.
+    nets = [net for net, _, _ in cover]
+    plens = [plen for _, plen, _ in cover]
+    masks = [comms for _, _, comms in cover]
+    prev = list(range(-1, len(cover) - 1))
+    nxt = list(range(1, len(cover) + 1))
+    if cover:
+        nxt[-1] = -1
+    alive = [True] * len(cover)
+    live = len(cover)
+
+    def merge_of(a: int) -> Optional[Tuple[float, int, int, int]]:
+        """The merge of node `a` with its successor: (cost per route saved,
+        supernet plen, first and last node absorbed), or None if not allowed."""
+        b = nxt[a]
+        if b < 0:
+            return None
+        cpl = 32 - (nets[a] ^ nets[b]).bit_length()
+        if cpl < BUDGET_MIN_PREFIXLEN:
+            return None
+        net = nets[a] & _prefix_mask(cpl)
+        last = net | 0xFFFFFFFF >> cpl
+        if own.overlaps(net, cpl):
+            return None
+        first = a
+        while prev[first] >= 0 and nets[prev[first]] >= net:
+            first = prev[first]
+        end = b
+        while nxt[end] >= 0 and nets[nxt[end]] <= last:
+            end = nxt[end]
+        size, count, node = 0, 0, first
+        while True:
+            size += 1 << (32 - plens[node])
+            count += 1
+            if node == end:
+                break
+            node = nxt[node]
+        return ((1 << (32 - cpl)) - size) / (count - 1), cpl, first, end
+
+    heap: List[Tuple[float, int]] = []
+    for a in range(len(cover)):
+        m = merge_of(a)
+        if m is not None:
+            heap.append((m[0], a))
+    heapq.heapify(heap)
+    while heap and live + fixed > budget:
+        cost, a = heapq.heappop(heap)
+        if not alive[a]:
+            continue
+        m = merge_of(a)
+        if m is None:
+            continue
+        if m[0] != cost:  # neighbours changed since it was queued
+            heapq.heappush(heap, (m[0], a))
+            continue
+        _, cpl, first, end = m
+        node = first
+        comms = 0
+        while True:
+            comms |= masks[node]
+            if node != first:
+                alive[node] = False
+                live -= 1
+            if node == end:
+                break
+            node = nxt[node]
+        nets[first] &= _prefix_mask(cpl)
+        plens[first] = cpl
+        masks[first] = comms
+        nxt[first] = nxt[end]
+        if nxt[end] >= 0:
+            prev[nxt[end]] = first
+        for node in (prev[first], first):
+            if node >= 0 and (m := merge_of(node)) is not None:
+                heapq.heappush(heap, (m[0], node))
+
+    for i in range(len(cover)):
+        if alive[i]:
+            result.add(nets[i], plens[i], masks[i])
+    # Measured on the class's address span, not summed per route: a supernet
+    # may land on (and merge with) a route already carrying the class.
+    return result, _class_span(result, class_mask) - _class_span(all_routes, class_mask)
+
+
+def _class_span(table: RouteTable, class_mask: int) -> int:
+    """Number of addresses covered by the routes of `table` in the class."""
+    return sum(
+        end - start + 1
+        for start, end in collapse_ranges(
+            (net, net | 0xFFFFFFFF >> plen) for net, plen, comms in table if comms & class_mask
+        )
+    )
 
 
 def parse_class_ranges(spec: str) -> List[Tuple[int, int]]:
@@ -398,6 +942,30 @@ def parse_class_ranges(spec: str) -> List[Tuple[int, int]]:
     return ranges
 
 
+def parse_route_budgets(spec: str) -> List[Tuple[int, int, int]]:
+    """Parse '200-399=50000,100-199=20000' into [(200,399,50000),(100,199,20000)].
+    Ranges are checked like --aggregate-classes; a budget must be a positive
+    integer. Fails closed."""
+    ranges: List[str] = []
+    budgets: List[int] = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        rng, sep, n = part.partition("=")
+        try:
+            budget = int(n)
+        except ValueError:
+            budget = 0
+        if not sep or budget <= 0:
+            print(f"ERROR: invalid route budget '{part}' (expected LO-HI=N, N > 0).")
+            sys.exit(1)
+        ranges.append(rng)
+        budgets.append(budget)
+    classes = parse_class_ranges(",".join(ranges))
+    return [(lo, hi, n) for (lo, hi), n in zip(classes, budgets)]
+
+
 def _strip_bird_comments(text: str) -> str:
     """Remove BIRD `/* */` block and `#` line comments so a commented-out filter
     reference isn't mistaken for a live one."""
@@ -590,56 +1158,118 @@ def write_own_infra_conf(
     print(f"Wrote OWN_INFRA include ({len(own)} prefixes) to {path}")
 
 
+def _prefix_mask(plen: int) -> int:
+    return 0xFFFFFFFF ^ (0xFFFFFFFF >> plen)
+
+
+def own_infra_ranges(own: Sequence[ipaddress.IPv4Network]) -> List[Tuple[int, int]]:
+    return [(int(b.network_address), int(b.broadcast_address)) for b in own]
+
+
+class OwnInfraIndex:
+    """Own-infra blocks merged into sorted, disjoint (start, end) intervals,
+    built once per run, so whether a route touches own infrastructure is one
+    bisect instead of a scan of the whole inventory."""
+
+    __slots__ = ("starts", "ends")
+
+    def __init__(self, ranges: Iterable[Tuple[int, int]]) -> None:
+        merged = collapse_ranges(ranges)
+        self.starts = array("I", (start for start, _ in merged))
+        self.ends = array("I", (end for _, end in merged))
+
+    @classmethod
+    def from_networks(cls, own: Sequence[ipaddress.IPv4Network]) -> "OwnInfraIndex":
+        return cls(own_infra_ranges(own))
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def overlaps(self, net: int, plen: int) -> bool:
+        """Whether the route shares any address with own infrastructure."""
+        i = bisect.bisect_right(self.starts, net | 0xFFFFFFFF >> plen) - 1
+        return i >= 0 and self.ends[i] >= net
+
+    def subtract(self, net: int, plen: int) -> List[RouteKey]:
+        """The route minus own infrastructure, as the minimal prefix cover of
+        the gaps (the route itself if disjoint, nothing if wholly inside)."""
+        last = net | 0xFFFFFFFF >> plen
+        starts, ends = self.starts, self.ends
+        i = bisect.bisect_right(starts, net) - 1
+        if i < 0 or ends[i] < net:
+            i += 1
+        remaining: List[RouteKey] = []
+        pos = net
+        while i < len(starts) and starts[i] <= last and pos <= last:
+            if starts[i] > pos:
+                remaining.extend(range_to_prefixes(pos, starts[i] - 1))
+            pos = ends[i] + 1
+            i += 1
+        if pos <= last:
+            remaining.extend(range_to_prefixes(pos, last))
+        return remaining
+
+
+def own_infra_leaks(
+    all_routes: RouteTable, own: Sequence[ipaddress.IPv4Network]
+) -> List[str]:
+    """CIDRs of the routes that share an address with an own-infra network.
+
+    Deliberately independent of OwnInfraIndex (it is the final check on what
+    the index excluded): the raw networks are sorted by start with a running
+    maximum of their ends, so a route [s, e] leaks iff the blocks starting at
+    or before e reach s. No merging, no prefix arithmetic.
+    """
+    blocks = sorted((int(n.network_address), int(n.broadcast_address)) for n in own)
+    starts = [start for start, _ in blocks]
+    reach: List[int] = []
+    for _, end in blocks:
+        reach.append(max(end, reach[-1]) if reach else end)
+    leaks: List[str] = []
+    for net, plen, _ in all_routes:
+        i = bisect.bisect_right(starts, net | 0xFFFFFFFF >> plen)
+        if i and reach[i - 1] >= net:
+            leaks.append(format_cidr(net, plen))
+    return leaks
+
+
 def exclude_own_infra(
-    all_routes: Dict[str, Set[int]], own: List[ipaddress.IPv4Network]
-) -> Dict[str, Set[int]]:
-    """Subtract own-infra networks from the route set (source-agnostic).
-
-    For each route and each own block, two CIDRs are either disjoint or one
-    contains the other:
-      - route wholly inside an own block (incl. equal) -> dropped
-      - own block strictly inside the route -> hole-punched via address_exclude
-      - disjoint -> kept unchanged
-    Community sets are carried onto every remainder prefix; remainders that
-    collapse onto the same CIDR have their communities merged.
+    all_routes: RouteTable, own: Union[OwnInfraIndex, Sequence[ipaddress.IPv4Network]]
+) -> Tuple[RouteTable, int]:
+    """Subtract own-infra networks (an OwnInfraIndex, or the networks to build
+    one from) from the route set (source-agnostic), in a single pass.
+
+    A route disjoint from own infrastructure (one bisect) is kept unchanged.
+    Otherwise it is replaced by the minimal prefix cover of what remains: a
+    route wholly inside an own block (incl. equal) is dropped, a route around
+    one is hole-punched into the siblings on the path down to it (what
+    IPv4Network.address_exclude yields). Communities are carried onto every
+    remainder prefix; remainders that collapse onto the same prefix have their
+    community masks OR-ed.
+
+    Returns the new table and how many source routes overlapped own-infra.
     """
+    if not isinstance(own, OwnInfraIndex):
+        own = OwnInfraIndex.from_networks(own)
     if not own:
-        return all_routes
+        return all_routes, 0
 
-    new_routes: Dict[str, Set[int]] = {}
-    for cidr, comms in all_routes.items():
-        try:
-            net = ipaddress.IPv4Network(cidr)
-        except ValueError:
-            # Should not happen (inputs are validated), keep as-is rather than lose it.
-            new_routes.setdefault(cidr, set()).update(comms)
+    new_routes = RouteTable()
+    matched = 0
+    for net, plen, comms in all_routes:
+        if not own.overlaps(net, plen):
+            new_routes.add(net, plen, comms)
             continue
+        matched += 1
+        for r_net, r_plen in own.subtract(net, plen):
+            new_routes.add(r_net, r_plen, comms)
 
-        remaining: List[ipaddress.IPv4Network] = [net]
-        for block in own:
-            nxt: List[ipaddress.IPv4Network] = []
-            for n in remaining:
-                if n.subnet_of(block):  # n fully inside own (incl. n == block)
-                    continue
-                if block.subnet_of(n):  # own strictly inside n -> punch hole
-                    nxt.extend(n.address_exclude(block))
-                else:  # disjoint
-                    nxt.append(n)
-            remaining = nxt
-            if not remaining:
-                break
-
-        for r in remaining:
-            new_routes.setdefault(str(r), set()).update(comms)
-
-    return new_routes
+    return new_routes, matched
 
 
 def validate_cidr(cidr: str) -> bool:
     try:
-        if "/" not in cidr:
-            cidr = f"{cidr}/32"
-        ipaddress.IPv4Network(cidr, strict=False)
+        parse_cidr(cidr)
         return True
     except ValueError:
         return False
@@ -657,28 +1287,389 @@ def atomic_write(filename: str, content: str) -> None:
     os.rename(tmp, filename)
 
 
-def parse_old_prefixes(filepath: str) -> Dict[str, Set[int]]:
-    """Parse existing prefixes.bird file into {CIDR: set of community suffixes}."""
-    result: Dict[str, Set[int]] = {}
+SPLIT_FILE_PREFIX = "bgp_prefixes_"
+
+
+def split_files() -> List[str]:
+    """The part files --split-output has published (ours by name)."""
+    return sorted(glob.glob(os.path.join(PREFIXES_DIR, SPLIT_FILE_PREFIX + "*.conf")))
+
+
+def split_part_fn(
+    registry: CommunityRegistry,
+    by: str,
+    classes: Sequence[Tuple[int, int]],
+    sources: Sequence[Source],
+) -> Callable[[int], str]:
+    """Memoized map from a community mask to the --split-output part its
+    route goes into: its class (`by` = "class", e.g. "200_399") or its source
+    (`by` = "source", the source name).
+
+    A route spanning several parts goes to "mixed": a prefix must live in
+    exactly one static protocol, or BIRD would hold two routes for it and
+    export only the better one with its communities. Communities outside
+    every class are the "other" part.
+    """
+    if by == "class":
+        labels = [(m, f"{lo}_{hi}") for (lo, hi), m in zip(classes, registry.class_masks(classes))]
+    else:
+        names = {src["community_suffix"]: src["name"] for src in sources}
+        labels = [(bit, names[c]) for c, bit in registry.bits.items()]
+    labelled = 0
+    for m, _ in labels:
+        labelled |= m
+    parts: Dict[int, str] = {}
+
+    def part_of(mask: int) -> str:
+        part = parts.get(mask)
+        if part is None:
+            hits = [label for m, label in labels if mask & m]
+            if mask & ~labelled:
+                hits.append("other")
+            part = parts[mask] = hits[0] if len(hits) == 1 else "mixed"
+        return part
+
+    return part_of
+
+
+def split_routes(all_routes: RouteTable, part_of: Callable[[int], str]) -> Dict[str, RouteTable]:
+    """Partition the feed by split_part_fn() label, keeping route order."""
+    parts: Dict[str, RouteTable] = {}
+    for net, plen, mask in all_routes:
+        part = part_of(mask)
+        table = parts.get(part)
+        if table is None:
+            table = parts[part] = RouteTable()
+        table.add(net, plen, mask)
+    return parts
+
+
+def route_action(registry: CommunityRegistry, mask: int) -> str:
+    """The BIRD route body for community `mask`, e.g.
+    `blackhole { bgp_community.add((AS, 100)); bgp_community.add((AS, 200)); };`
+    """
+    # Correct format: bgp_community.add((ASN, VALUE));
+    # If multiple: { bgp_community.add((ASN, V1)); bgp_community.add((ASN, V2)); }
+    adds = [f"bgp_community.add(({LOCAL_AS}, {suffix}));" for suffix in registry.decode(mask)]
+    return f"blackhole {{ {' '.join(adds)} }};"
+
+
+def write_feed(
+    all_routes: RouteTable,
+    registry: CommunityRegistry,
+    bird_tmp: Optional[str],
+    txt_tmp: Optional[str],
+    protocol: Optional[str] = None,
+) -> str:
+    """Stream the feed into `bird_tmp` (BIRD routes) and `txt_tmp` (bare
+    CIDRs) in one pass: each route is rendered once and written straight out,
+    so memory does not grow with the rendered size. Either path may be None to
+    skip that file. With `protocol`, the routes are wrapped in their own
+    `protocol static <protocol>` stanza (--split-output). Returns the sha256
+    of the BIRD rendering, hashed as it is written (also when `bird_tmp` is
+    None).
+
+    Self-check: a route body with the invalid list form
+    `bgp_community.add([(` aborts the run (fail-closed) before anything is
+    published; the temp files are removed.
+    """
+    paths = [path for path in (bird_tmp, txt_tmp) if path is not None]
+    for path in paths:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    digest = hashlib.sha256()
+    actions: Dict[int, bytes] = {}  # community mask -> rendered route body
+    with open(bird_tmp or os.devnull, "wb") as bird, open(txt_tmp or os.devnull, "wb") as txt:
+        if protocol is not None:
+            head = (
+                f"# Generated by prefix_updater.py (--split-output). Do NOT edit by hand.\n"
+                f"protocol static {protocol} {{\n"
+                f"    ipv4 {{ table t_bgp_prefixes; }};\n"
+            ).encode()
+            bird.write(head)
+            digest.update(head)
+        indent = b"" if protocol is None else b"    "
+        sep, txt_sep = indent, b""
+        for net, plen, mask in all_routes:
+            action = actions.get(mask)
+            if action is None:
+                text = route_action(registry, mask)
+                if "bgp_community.add([(" in text:
+                    print(
+                        "\nERROR: Invalid community format detected "
+                        "(found 'bgp_community.add([(')."
+                    )
+                    print(f"  Invalid line: route {format_cidr(net, plen)} {text}")
+                    bird.close()
+                    txt.close()
+                    for path in paths:
+                        os.remove(path)
+                    sys.exit(1)
+                action = actions[mask] = f" {text}".encode()
+            cidr = format_cidr(net, plen).encode()
+            line = sep + b"route " + cidr + action
+            bird.write(line)
+            digest.update(line)
+            txt.write(txt_sep + cidr)
+            sep, txt_sep = b"\n" + indent, b"\n"
+        if protocol is not None:
+            tail = b"\n}\n" if len(all_routes) else b"}\n"
+            bird.write(tail)
+            digest.update(tail)
+        for f, path in ((bird, bird_tmp), (txt, txt_tmp)):
+            if path is not None:
+                f.flush()
+                os.fsync(f.fileno())
+    return digest.hexdigest()
+
+
+def parse_old_prefixes(filepath: str, registry: CommunityRegistry) -> Tuple[RouteTable, bool]:
+    """Parse existing prefixes.bird file into a RouteTable. Communities of
+    sources that no longer exist have no bit and are dropped.
+
+    Also returns whether the file is canonical: exactly what the writer would
+    render for that table (sorted, unique, only known communities, current
+    LOCAL_AS). Only then does an empty diff against it mean the file needs no
+    rewrite.
+    """
+    result = RouteTable()
     if not os.path.exists(filepath):
-        return result
+        return result, False
     with open(filepath, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line.startswith("route "):
-                continue
-            parts = line.split()
-            cidr = parts[1]
-            comms: Set[int] = set()
-            for match in re.finditer(r"\(\d+,\s*(\d+)\)", line):
-                comms.add(int(match.group(1)))
-            if cidr and comms:
-                result[cidr] = comms
-    return result
+        text = f.read()
+    canonical = True
+    actions: Dict[str, int] = {}  # canonical route body -> community mask
+    prev = -1
+    for line in text.split("\n") if text else ():
+        stripped = line.strip()
+        if not stripped.startswith("route "):
+            canonical = False
+            continue
+        parts = stripped.split(" ", 2)
+        try:
+            net, plen = parse_cidr(parts[1])
+        except (IndexError, ValueError):
+            canonical = False
+            continue
+        tail = parts[2] if len(parts) > 2 else ""
+        comms = actions.get(tail)
+        if comms is None:
+            comms = registry.mask(
+                int(match.group(1)) for match in re.finditer(r"\(\d+,\s*(\d+)\)", tail)
+            )
+            if comms and tail == route_action(registry, comms):
+                actions[tail] = comms
+            else:
+                canonical = False
+        if comms:
+            result.add(net, plen, comms)
+        if canonical:
+            key = net << 6 | plen
+            canonical = key > prev and line == f"route {format_cidr(net, plen)} {tail}"
+            prev = key
+    return result, canonical
+
+
+FEED_STATE_MAGIC = b"BPU-STATE-1\n"
+
+
+def _feed_state_path() -> str:
+    return OUTPUT_BIRD + ".state"
+
+
+def _published_files() -> List[str]:
+    """OUTPUT_BIRD and every --split-output part file."""
+    return [OUTPUT_BIRD, *split_files()]
+
+
+def save_feed_state(
+    table: RouteTable,
+    registry: CommunityRegistry,
+    split: Optional[str] = None,
+) -> None:
+    """Write the binary snapshot of the feed just published, so the next run
+    can load it instead of parsing the text (atomic).
+
+    Layout: magic, a length-prefixed JSON header (LOCAL_AS, the community
+    suffix of each mask bit, the --split-output mode and size / mtime /
+    sha256 of each published file), the RouteTable dump, and a sha256 of all
+    of it.
+    """
+    files: Dict[str, List[Any]] = {}
+    for published in _published_files():
+        st = os.stat(published)
+        files[published] = [st.st_size, st.st_mtime_ns, file_sha256(published)]
+    header = json.dumps({
+        "local_as": LOCAL_AS,
+        "suffixes": registry.suffixes,
+        "split": split,
+        "files": files,
+    }).encode()
+    body = io.BytesIO()
+    body.write(FEED_STATE_MAGIC + len(header).to_bytes(4, "little") + header)
+    table.dump(body)
+    payload = body.getvalue()
+    path = _feed_state_path()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+        f.write(hashlib.sha256(payload).digest())
+    os.replace(tmp_path, path)
+
+
+def load_feed_state(
+    registry: CommunityRegistry, split: Optional[str] = None
+) -> Optional[Tuple[RouteTable, bool]]:
+    """The snapshot written by save_feed_state(), if it still describes the
+    published files: same LOCAL_AS, the same set of files with unchanged size,
+    mtime and content (hashed only once size and mtime match, so an edit that
+    kept both, e.g. `cp -p`, is caught too). None when missing or stale; a
+    corrupt snapshot is warned about and ignored.
+
+    Masks are re-mapped to `registry` if the sources changed since (suffixes
+    without a bit are dropped, as parse_old_prefixes does); the feed is then
+    no longer what the writer would render, so it is reported non-canonical,
+    as it is when it was published with another --split-output mode.
+    """
+    path = _feed_state_path()
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        published = _published_files()
+    except OSError:
+        return None
+    try:
+        payload, checksum = data[:-32], data[-32:]
+        if not payload.startswith(FEED_STATE_MAGIC) or hashlib.sha256(payload).digest() != checksum:
+            raise ValueError("bad magic or checksum")
+        f = io.BytesIO(payload)
+        f.seek(len(FEED_STATE_MAGIC))
+        header = json.loads(f.read(int.from_bytes(f.read(4), "little")))
+        files = header["files"]
+        if header["local_as"] != LOCAL_AS or sorted(files) != sorted(published):
+            return None
+        for published_path in published:
+            size, mtime_ns, digest = files[published_path]
+            st = os.stat(published_path)
+            if (
+                st.st_size != size
+                or st.st_mtime_ns != mtime_ns
+                or file_sha256(published_path) != digest
+            ):
+                return None
+        table = RouteTable.read(f, path)
+        if f.read(1):
+            raise ValueError("trailing data")
+        old = CommunityRegistry(header["suffixes"])
+    except OSError:
+        return None
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"WARNING: Ignoring corrupt feed state {path}: {e}")
+        return None
+    same_mode = header.get("split") == split
+    if old.suffixes == registry.suffixes:
+        return table, same_mode
+    remapped: Dict[int, int] = {}
+    result = RouteTable()
+    for net, plen, mask in table:
+        new_mask = remapped.get(mask)
+        if new_mask is None:
+            new_mask = remapped[mask] = registry.mask(old.decode(mask))
+        if new_mask:
+            result.add(net, plen, new_mask)
+    return result, False
+
+
+def load_old_routes(
+    registry: CommunityRegistry, split: Optional[str] = None
+) -> Tuple[RouteTable, bool, bool]:
+    """The currently published feed and whether it is canonical for this
+    run's output mode (see parse_old_prefixes), from the binary snapshot when
+    it is current, else by parsing OUTPUT_BIRD and any --split-output part
+    files. The last item says whether the snapshot was used."""
+    state = load_feed_state(registry, split)
+    if state is not None:
+        return state[0], state[1], True
+    table, canonical = parse_old_prefixes(OUTPUT_BIRD, registry)
+    parts = split_files()
+    for part in parts:
+        for net, plen, mask in parse_old_prefixes(part, registry)[0]:
+            table.add(net, plen, mask)
+    return table, canonical and not parts and split is None, False
+
+
+class RouteDiff:
+    """What changed between two route tables: prefixes added, removed, and
+    kept with different communities. Each is (network, prefixlen, mask) —
+    for `changed`, (network, prefixlen, old mask, new mask)."""
+
+    __slots__ = ("added", "removed", "changed")
+
+    def __init__(self) -> None:
+        self.added: List[Tuple[int, int, int]] = []
+        self.removed: List[Tuple[int, int, int]] = []
+        self.changed: List[Tuple[int, int, int, int]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+    def summary(self) -> str:
+        return f"+{len(self.added)} -{len(self.removed)} ~{len(self.changed)} (community)"
+
+
+PLAN_MAX_LINES = 50  # routes listed per kind of change by --plan
+
+
+def print_plan(diff: RouteDiff, registry: CommunityRegistry) -> None:
+    """Print a --plan listing of `diff`, at most PLAN_MAX_LINES per kind."""
+    sections = [
+        ("Added", "+", diff.added),
+        ("Removed", "-", diff.removed),
+        ("Community changed", "~", diff.changed),
+    ]
+    for title, sign, rows in sections:
+        if not rows:
+            continue
+        print(f"\n{title} ({len(rows)}):")
+        for net, plen, *masks in rows[:PLAN_MAX_LINES]:
+            comms = " -> ".join(str(registry.decode(mask)) for mask in masks)
+            print(f"  {sign} {format_cidr(net, plen):<18} {comms}")
+        if len(rows) > PLAN_MAX_LINES:
+            print(f"  ... and {len(rows) - PLAN_MAX_LINES} more")
+
+
+def diff_routes(old: RouteTable, new: RouteTable) -> RouteDiff:
+    """Diff two tables in one merge over their sorted (network, prefixlen) keys."""
+    diff = RouteDiff()
+    old_it, new_it = iter(old), iter(new)
+    o = next(old_it, None)
+    n = next(new_it, None)
+    while o is not None and n is not None:
+        o_key, n_key = o[0] << 6 | o[1], n[0] << 6 | n[1]
+        if o_key < n_key:
+            diff.removed.append(o)
+            o = next(old_it, None)
+        elif n_key < o_key:
+            diff.added.append(n)
+            n = next(new_it, None)
+        else:
+            if o[2] != n[2]:
+                diff.changed.append((n[0], n[1], o[2], n[2]))
+            o = next(old_it, None)
+            n = next(new_it, None)
+    if o is not None:
+        diff.removed.append(o)
+        diff.removed.extend(old_it)
+    if n is not None:
+        diff.added.append(n)
+        diff.added.extend(new_it)
+    return diff
 
 
 def _parse_json_prefixes(raw_data: str, source: Source) -> List[str]:
-    data = json.loads(raw_data)
+    return _json_prefixes(json.loads(raw_data), source)
+
+
+def _json_prefixes(data: Any, source: Source) -> List[str]:
     if source["format"] == "aws_json":
         aws_services = {service.upper() for service in source.get("aws_services", [])}
         return [
@@ -701,25 +1692,603 @@ def _parse_json_prefixes(raw_data: str, source: Source) -> List[str]:
     return []
 
 
-def _parse_cached_data(cache_path: str, source: Source) -> Optional[List[str]]:
-    """Parse a cached file for a given source. Returns list of prefixes or None on error."""
+def txt_digest(all_routes: RouteTable) -> Tuple[int, str]:
+    """Size and sha256 of prefixes.txt as write_feed() renders `all_routes`."""
+    h = hashlib.sha256()
+    size = 0
+    sep = b""
+    for net, plen, _mask in all_routes:
+        line = sep + format_cidr(net, plen).encode()
+        h.update(line)
+        size += len(line)
+        sep = b"\n"
+    return size, h.hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _cache_path(name: str, url: str) -> str:
+    url_hash = hashlib.sha256(url.encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"{name}_{url_hash}.cache")
+
+
+def _open_cache_text(path: str) -> Any:
+    """Open a cached body (or local list) for reading as text, transparently
+    gunzipping bodies stored with CACHE_COMPRESS=1 (detected by magic, so
+    plain and compressed entries can coexist)."""
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def _touch_cache(path: str) -> None:
+    """Record a cache use for LRU eviction. The access time is the LRU clock;
+    the modification time is left alone, it is the CACHE_TTL clock."""
     try:
-        with open(cache_path, "r", encoding="utf-8") as f:
-            raw_data = f.read()
-        if source["format"] in {"json", "aws_json"}:
-            return _parse_json_prefixes(raw_data, source)
+        st = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+    except OSError:
+        pass
+
+
+def gc_cache(sources: Sequence[Source], max_bytes: Optional[int] = None) -> None:
+    """Prune CACHE_DIR: remove orphans, then evict LRU entries over budget.
+
+    Orphans are bodies, validator sidecars and ranges files that no current
+    source/URL (renamed sources, changed URLs) can ever read again, plus temp
+    files left over for more than an hour. Then, while the directory exceeds
+    `max_bytes` (default CACHE_MAX_BYTES, 0 = unlimited), whole entries (a
+    body with its `.meta`, or a ranges file) are evicted least recently used
+    first. Files this updater does not own are never touched.
+    """
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+    if not os.path.isdir(CACHE_DIR):
+        return
+
+    expected: Set[str] = set()
+    for src in sources:
+        expected.add(os.path.basename(_ranges_cache_path(src)))
+        for url in itertools.chain.from_iterable(source_units(src)):
+            if url.startswith("http"):
+                expected.add(os.path.basename(_cache_path(src["name"], url)))
+
+    now = time.time()
+    orphans: List[str] = []
+    # entry (body or ranges file) -> [files, bytes, last use]
+    entries: Dict[str, List[Any]] = {}
+    for fn in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, fn)
+        if fn.endswith(".tmp"):
+            try:
+                if now - os.path.getmtime(path) > 3600:
+                    orphans.append(path)
+            except OSError:
+                pass
+            continue
+        entry = fn[: -len(".meta")] if fn.endswith(".cache.meta") else fn
+        if not entry.endswith((".cache", ".ranges")):
+            continue
+        if entry not in expected:
+            orphans.append(path)
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files, size, used = entries.setdefault(entry, [[], 0, now])
+        files.append(path)
+        entries[entry][1] = size + st.st_size
+        if fn == entry:
+            entries[entry][2] = st.st_atime
+
+    for path in orphans:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    evicted, freed = 0, 0
+    total = sum(size for _, size, _ in entries.values())
+    if max_bytes > 0 and total > max_bytes:
+        for files, size, _ in sorted(entries.values(), key=lambda e: e[2]):
+            if total <= max_bytes:
+                break
+            for path in files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            freed += size
+            evicted += 1
+
+    if orphans or evicted:
+        print(
+            f"  Cache GC: removed {len(orphans)} orphan file(s), evicted "
+            f"{evicted} entr{'y' if evicted == 1 else 'ies'} "
+            f"({freed // 1024} KiB) over budget; {total // 1024} KiB in use"
+        )
+
+
+class _CachedBody:
+    """A source body on disk (cache entry or local file) whose prefixes are
+    parsed lazily, on every iteration.
+
+    Returned instead of a list so a large text list (e.g. ip.lst) is streamed
+    line by line into the pipeline in main() rather than held in memory as one
+    string plus one list per stage; blank and '#' lines are skipped, as for
+    every text source. JSON bodies are parsed per document when iterated, or
+    not at all if main() finds the source in the ranges cache (see `digest`).
+    `items` carries prefixes already parsed while validating a JSON body.
+    """
+
+    def __init__(self, path: str, source: Source,
+                 items: Optional[List[str]] = None) -> None:
+        self.path = path
+        self.source = source
+        self.items = items
+        self._digest: Optional[str] = None
+
+    @property
+    def digest(self) -> str:
+        """sha256 of the raw body, computed once (hashing is far cheaper
+        than parsing)."""
+        if self._digest is None:
+            self._digest = file_sha256(self.path)
+        return self._digest
+
+    def __iter__(self) -> Iterator[str]:
+        if self.items is not None:
+            yield from self.items
+        elif self.source["format"] in {"json", "aws_json"}:
+            yield from _parse_json_file(self.path, self.source)
         else:
-            return [
-                line.strip()
-                for line in raw_data.splitlines()
-                if line.strip() and not line.startswith("#")
-            ]
+            with _open_cache_text(self.path) as f:
+                for line in f:
+                    item = line.strip()
+                    if item and not line.startswith("#"):
+                        yield item
+
+    def __bool__(self) -> bool:
+        items = iter(self)
+        try:
+            return next(items, None) is not None
+        finally:
+            items.close()  # type: ignore[attr-defined]
+
+
+def _parse_json_file(path: str, source: Source) -> List[str]:
+    with _open_cache_text(path) as f:
+        return _json_prefixes(json.load(f), source)
+
+
+def _parse_cached_data(cache_path: str, source: Source) -> Optional[Iterable[str]]:
+    """Parse a cached file for a given source. Returns its prefixes as a
+    _CachedBody (the type fresh downloads return, so the ranges cache and the
+    input manifest treat both alike), or None on error.
+
+    Text lists stream the file lazily. A JSON document is parsed here, in
+    full (the stdlib has no incremental parser), so a corrupt one is rejected
+    now rather than mid-pipeline; its prefixes ride along in `items`, as for
+    a fresh JSON download.
+    """
+    try:
+        if source["format"] in {"json", "aws_json"}:
+            return _CachedBody(cache_path, source, _parse_json_file(cache_path, source))
+        with _open_cache_text(cache_path):
+            pass  # fail here, not mid-pipeline, if the file is unreadable
+        return _CachedBody(cache_path, source)
     except Exception as e:
         print(f"Cache parse error for {source['name']}: {e}")
         return None
 
 
-def download_resource(source: Source, force_refresh: bool = False) -> Optional[List[str]]:
+def _cached_body(cache_path: str, source: Source) -> Optional[_CachedBody]:
+    """Lazy view of a cache entry, without parsing it; None if unreadable."""
+    try:
+        with open(cache_path, "rb"):
+            pass
+    except OSError as e:
+        print(f"Cache parse error for {source['name']}: {e}")
+        return None
+    return _CachedBody(cache_path, source)
+
+
+class _PooledHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, pool: "HTTPPool", host: str, port: int, timeout: float) -> None:
+        super().__init__(host, port, timeout=timeout)
+        self._pool = pool
+
+    def connect(self) -> None:
+        self.sock = self._pool.connect_socket(self.host, self.port, self.timeout)
+
+
+class _PooledHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, pool: "HTTPPool", host: str, port: int, timeout: float) -> None:
+        super().__init__(host, port, timeout=timeout, context=pool.ssl_context)
+        self._pool = pool
+
+    def connect(self) -> None:
+        sock = self._pool.connect_socket(self.host, self.port, self.timeout)
+        self.sock = self._pool.ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+
+class _PooledResponse:
+    """urlopen()-like response that hands its connection back to the pool once
+    the body has been read in full."""
+
+    def __init__(self, pool: "HTTPPool", key: Tuple[str, str, int],
+                 conn: http.client.HTTPConnection,
+                 resp: http.client.HTTPResponse) -> None:
+        self._pool, self._key, self._conn, self._resp = pool, key, conn, resp
+        self.status = resp.status
+        self.headers = resp.headers
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        return self._resp.read(amt)
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._pool.release(self._key, self._conn, self._resp)
+            self._conn = None
+
+    def __enter__(self) -> "_PooledResponse":
+        return self
+
+    def __exit__(self, *_exc: Any) -> None:
+        self.close()
+
+
+class HTTPPool:
+    """Keep-alive HTTP(S) connections and DNS answers shared by the downloads
+    of one fetch_sources() call, so the dozen stat.ripe.net sources pay for a handful of TCP/TLS
+    handshakes and one lookup instead of one each.
+
+    Idle connections are kept per (scheme, host, port); a connection is only
+    reused after its previous response was read to the end and the server did
+    not ask to close it. Redirects are followed like urlopen() does, and error
+    statuses (including 304) raise urllib.error.HTTPError so callers handle both
+    transports the same way. close() drops all connections and cached lookups
+    and marks the pool closed: a connection released afterwards (by a worker
+    fetch_sources() cancelled or stopped waiting for) is closed, not pooled.
+    """
+
+    def __init__(self) -> None:
+        self.ssl_context = ssl.create_default_context()
+        self._lock = threading.Lock()
+        self._idle: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+        self._dns: Dict[Tuple[str, int], List[Any]] = {}
+        self.closed = False
+
+    def connect_socket(self, host: str, port: int, timeout: Any) -> socket.socket:
+        with self._lock:
+            infos = self._dns.get((host, port))
+        if infos is None:
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            with self._lock:
+                if not self.closed:
+                    self._dns[(host, port)] = infos
+        err: Optional[OSError] = None
+        for family, socktype, proto, _name, addr in infos:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.settimeout(timeout)
+                sock.connect(addr)
+                return sock
+            except OSError as e:
+                sock.close()
+                err = e
+        raise err if err is not None else OSError(f"no addresses for {host}")
+
+    def _acquire(self, key: Tuple[str, str, int],
+                 timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            conn.timeout = timeout
+            return conn, True
+        return self._new_connection(key, timeout), False
+
+    def _new_connection(self, key: Tuple[str, str, int],
+                        timeout: float) -> http.client.HTTPConnection:
+        scheme, host, port = key
+        cls = _PooledHTTPSConnection if scheme == "https" else _PooledHTTPConnection
+        return cls(self, host, port, timeout)
+
+    def release(self, key: Tuple[str, str, int], conn: http.client.HTTPConnection,
+                resp: http.client.HTTPResponse) -> None:
+        if resp.isclosed() and not resp.will_close and conn.sock is not None:
+            with self._lock:
+                if not self.closed:
+                    self._idle.setdefault(key, []).append(conn)
+                    return
+        resp.close()
+        conn.close()
+
+    def open(self, url: str, headers: Dict[str, str], timeout: float) -> _PooledResponse:
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            scheme = parts.scheme.lower()
+            port = parts.port or (443 if scheme == "https" else 80)
+            key = (scheme, parts.hostname or "", port)
+            target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+            conn, reused = self._acquire(key, timeout)
+            try:
+                try:
+                    conn.request("GET", target, headers=headers)
+                    resp = conn.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionResetError,
+                        BrokenPipeError):
+                    conn.close()
+                    if not reused:
+                        raise
+                    # The server dropped an idle keep-alive connection: redo
+                    # the request once on a fresh one.
+                    conn = self._new_connection(key, timeout)
+                    conn.request("GET", target, headers=headers)
+                    resp = conn.getresponse()
+                location = None
+                if resp.status in (301, 302, 303, 307, 308):
+                    location = resp.headers.get("Location")
+                body = resp.read() if location or resp.status >= 300 else b""
+            except BaseException:
+                # Any other failure leaves the connection mid-exchange: it is
+                # never pooled, and its socket is closed here.
+                conn.close()
+                raise
+
+            if location:
+                self.release(key, conn, resp)
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if resp.status >= 300:
+                self.release(key, conn, resp)
+                raise urllib.error.HTTPError(
+                    url, resp.status, resp.reason, resp.headers, io.BytesIO(body)
+                )
+            return _PooledResponse(self, key, conn, resp)
+        raise urllib.error.URLError(f"too many redirects for {url}")
+
+    def close(self) -> None:
+        with self._lock:
+            self.closed = True
+            idle, self._idle, self._dns = self._idle, {}, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+def _http_open(url: str, headers: Dict[str, str], timeout: float,
+               pool: Optional[HTTPPool] = None) -> Any:
+    """GET `url` through the keep-alive `pool`, or with a one-off urlopen()
+    when there is none (download_resource() called outside fetch_sources()).
+
+    Requests that must go through a configured proxy (http_proxy / https_proxy
+    and no_proxy, as urllib honours them) keep using urlopen() so proxied
+    deployments behave exactly as before.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(
+        parts.hostname or ""
+    ):
+        pool = None
+    if pool is None:
+        req = urllib.request.Request(url, headers=headers)
+        return urllib.request.urlopen(req, timeout=timeout)
+    return pool.open(url, headers, timeout)
+
+
+class _BodyDecoder:
+    """Incrementally undo the Content-Encoding negotiated via Accept-Encoding.
+
+    `deflate` is specified as zlib-wrapped but some servers send a raw deflate
+    stream, so the first bytes decide which one it is. Anything else is refused
+    (the attempt fails and is retried) rather than caching an undecodable body.
+    """
+
+    def __init__(self, content_encoding: Optional[str]) -> None:
+        self.encoding = (content_encoding or "identity").strip().lower()
+        self._zlib: Any = None
+        if self.encoding in ("gzip", "x-gzip"):
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding not in ("identity", "deflate"):
+            raise ValueError(f"unsupported Content-Encoding '{content_encoding}'")
+
+    def decompress(self, chunk: bytes) -> bytes:
+        if self.encoding == "identity" or not chunk:
+            return chunk
+        if self._zlib is None:  # deflate: sniff the zlib header (RFC 1950)
+            zlib_wrapped = (
+                len(chunk) >= 2
+                and chunk[0] & 0x0F == 8
+                and ((chunk[0] << 8) | chunk[1]) % 31 == 0
+            )
+            self._zlib = zlib.decompressobj(
+                zlib.MAX_WBITS if zlib_wrapped else -zlib.MAX_WBITS
+            )
+        return self._zlib.decompress(chunk)
+
+    def flush(self) -> bytes:
+        return self._zlib.flush() if self._zlib is not None else b""
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a download fetch_sources() no longer wants (the run
+    deadline passed, or its unit settled on another mirror)."""
+
+
+class CancelToken:
+    """Stops one download running on a fetch_sources() worker thread.
+
+    The read loop checks it after every chunk, and cancel() also shuts down
+    the socket being read, so a read blocked on a stalled server returns at
+    once. Cache writes go through commit(), under the same lock as cancel():
+    an attempt cancelled before it commits never touches the cache, and one
+    that committed first was done before cancel() returned. Connect and DNS
+    cannot be interrupted; they stay bounded by the request timeout.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._sock: Optional[socket.socket] = None
+
+    @staticmethod
+    def _shutdown(sock: Optional[socket.socket]) -> None:
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._cancelled = True
+            sock, self._sock = self._sock, None
+        self._shutdown(sock)
+
+    def check(self) -> None:
+        if self._cancelled:
+            raise DownloadCancelled("download cancelled")
+
+    def attach(self, sock: Optional[socket.socket]) -> None:
+        """Register the socket of the response about to be read."""
+        with self._lock:
+            if not self._cancelled:
+                self._sock = sock
+                return
+        self._shutdown(sock)
+        self.check()
+
+    @contextlib.contextmanager
+    def commit(self) -> Iterator[None]:
+        with self._lock:
+            self.check()
+            yield
+
+
+def _response_socket(response: Any) -> Optional[socket.socket]:
+    """The socket a response body is read from (pooled or urlopen()), or None."""
+    conn = getattr(response, "_conn", None)
+    if conn is not None:
+        return conn.sock
+    raw = getattr(getattr(response, "fp", None), "raw", None)
+    return getattr(raw, "_sock", None)
+
+
+def _read_body(response: Any, sink: Any, cancel: Optional[CancelToken] = None) -> None:
+    """Stream a response body into `sink` chunk by chunk: decompressed, and
+    checked to be valid UTF-8 so a bad body fails the attempt instead of
+    reaching the cache. Raises DownloadCancelled once `cancel` fires (a
+    shut-down socket reads as EOF, so the check follows every read)."""
+    decoder = _BodyDecoder(response.headers.get("Content-Encoding"))
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        chunk = response.read(DOWNLOAD_CHUNK)
+        if cancel is not None:
+            cancel.check()
+        if not chunk:
+            break
+        data = decoder.decompress(chunk)
+        utf8.decode(data)
+        sink.write(data)
+    tail = decoder.flush()
+    utf8.decode(tail, final=True)
+    sink.write(tail)
+
+
+def _cache_meta_path(cache_path: str) -> str:
+    return cache_path + ".meta"
+
+
+def _conditional_headers(cache_path: str) -> Dict[str, str]:
+    """If-None-Match / If-Modified-Since for a cached body, from its sidecar
+    `.meta` file. Empty (unconditional request) if there is nothing usable."""
+    try:
+        with open(_cache_meta_path(cache_path), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    headers: Dict[str, str] = {}
+    if isinstance(meta, dict):
+        if meta.get("etag"):
+            headers["If-None-Match"] = str(meta["etag"])
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = str(meta["last_modified"])
+    return headers
+
+
+def _write_cache_meta(cache_path: str, headers: Any) -> None:
+    """Store the response validators next to a freshly written cache body
+    (nothing is written if the upstream sent neither ETag nor Last-Modified)."""
+    meta = {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
+    if not any(meta.values()):
+        return
+    with open(_cache_meta_path(cache_path), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+class RetryLater(Exception):
+    """Raised by a scheduled download_resource() attempt that failed but has
+    attempts left, so fetch_sources() can retry it after `delay` seconds
+    without parking a worker in time.sleep()."""
+
+    def __init__(self, delay: float) -> None:
+        super().__init__(f"retry in {delay}s")
+        self.delay = delay
+
+
+def _stale_cache_fallback(cache_path: str, source: Source) -> Optional[Iterable[str]]:
+    """Expired cache within STALE_CACHE_MAX_AGE, for a source that could not
+    be downloaded; None if there is none (the caller then FALLBACKs)."""
+    if os.path.exists(cache_path):
+        cache_age = time.time() - os.path.getmtime(cache_path)
+        if cache_age <= STALE_CACHE_MAX_AGE:
+            stale_data = _parse_cached_data(cache_path, source)
+            if stale_data:
+                print(
+                    f"WARNING: Using stale cache for {source['name']} (age: {cache_age / 3600:.1f}h)"
+                )
+                _touch_cache(cache_path)
+                return stale_data
+        else:
+            print(
+                f"WARNING: Stale cache for {source['name']} too old ({cache_age / 86400:.1f} days), discarding"
+            )
+    return None
+
+
+def download_resource(
+    source: Source, force_refresh: bool = False
+) -> Optional[Iterable[str]]:
+    """Prefixes of one source URL, or None if it failed with no usable cache.
+
+    Called standalone it runs the whole retry loop itself. fetch_sources()
+    instead drives one attempt per call through keys on its private copy of
+    the source: "_attempt" (1-based; a failure with attempts left raises
+    RetryLater instead of sleeping), "_deadline" (absolute time that caps the
+    request timeout), "_offline" (why the network must be skipped, e.g. the
+    deadline passed: use the cache or nothing), "_cancel" (a CancelToken;
+    once fired the attempt raises DownloadCancelled and writes nothing to the
+    cache) and "_pool" (the call's HTTPPool). It reads back "_outcome":
+    "cached", "fetched" (new body or 304) or "failed" (even if the stale cache
+    then stood in).
+    """
     # Static prefix list baked into the source (no fetch). Used for entities
     # that have their own IP space but no usable own ASN (e.g. Threema's PI
     # block routed through a shared provider AS), so the per-ASN RIPEstat
@@ -733,12 +2302,9 @@ def download_resource(source: Source, force_refresh: bool = False) -> Optional[L
     if not url.startswith("http"):
         if os.path.exists(url):
             try:
-                with open(url, "r", encoding="utf-8") as f:
-                    return [
-                        line.strip()
-                        for line in f
-                        if line.strip() and not line.startswith("#")
-                    ]
+                with open(url, "r", encoding="utf-8"):
+                    pass
+                return _CachedBody(url, source)
             except Exception as e:
                 print(f"Error reading local file {url}: {e}")
                 return []
@@ -746,69 +2312,690 @@ def download_resource(source: Source, force_refresh: bool = False) -> Optional[L
             print(f"Warning: Local file {url} not found.")
             return []
 
-    url_hash = hashlib.sha256(url.encode()).hexdigest()[:16]
-    cache_path = os.path.join(CACHE_DIR, f"{source['name']}_{url_hash}.cache")
+    cache_path = _cache_path(source["name"], url)
 
+    # Validators from the last full download; sent on expiry so an unchanged
+    # upstream answers 304 and the cached body is reused without a transfer.
+    validators: Dict[str, str] = {}
+    revalidated: Optional[Iterable[str]] = None
     if not force_refresh and os.path.exists(cache_path):
         mtime = os.path.getmtime(cache_path)
         if time.time() - mtime < CACHE_TTL:
-            result = _parse_cached_data(cache_path, source)
+            result = _cached_body(cache_path, source)
             if result is not None:
                 print(f"Using cached data for {source['name']} ({url})")
+                _touch_cache(cache_path)
+                source["_outcome"] = "cached"
                 return result
             else:
                 print(f"Cache read error for {source['name']}: re-downloading...")
-
+        else:
+            validators = _conditional_headers(cache_path)
+            # Only revalidate a body we can still read; otherwise a 304 would
+            # leave us with nothing to reuse.
+            if validators:
+                revalidated = _cached_body(cache_path, source)
+            if revalidated is None:
+                validators = {}
+
+    if source.get("_offline"):
+        reason = source["_offline"]
+        if reason is True:
+            reason = "run deadline reached"
+        print(f"WARNING: Not downloading {source['name']} ({url}): {reason}")
+        return _stale_cache_fallback(cache_path, source)
+
+    scheduled = "_attempt" in source
+    attempts = [source["_attempt"]] if scheduled else range(1, MAX_RETRIES + 1)
+    cancel = source.get("_cancel") or CancelToken()
     print(f"Downloading {source['name']} from {url}...")
-    for attempt in range(1, MAX_RETRIES + 1):
+    for attempt in attempts:
+        cancel.check()
+        timeout = 30.0
+        if source.get("_deadline") is not None:
+            timeout = max(1.0, min(timeout, source["_deadline"] - time.time()))
         try:
-            req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
-            with urllib.request.urlopen(req, timeout=30) as response:
-                raw_data = response.read().decode("utf-8")
-
-                # Save to cache
+            try:
+                response = _http_open(
+                    url,
+                    {
+                        "User-Agent": USER_AGENT,
+                        "Accept-Encoding": "gzip, deflate",
+                        **validators,
+                    },
+                    timeout=timeout,
+                    pool=source.get("_pool"),
+                )
+            except urllib.error.HTTPError as e:
+                if e.code != 304 or revalidated is None:
+                    raise
+                e.close()
+                # Unchanged upstream: restart the TTL on the existing body.
+                with cancel.commit():
+                    os.utime(cache_path)
+                print(f"Not modified: {source['name']} ({url}), reusing cache")
+                source["_outcome"] = "fetched"
+                return revalidated
+            with response:
+                cancel.attach(_response_socket(response))
+                # The body is streamed to a temp file next to the cache (the
+                # cache holds the decoded text the parsers expect) and only
+                # replaces the cache once it is complete and parses.
+                tmp_path = cache_path + ".tmp"
                 try:
                     os.makedirs(CACHE_DIR, exist_ok=True)
-                    with open(cache_path, "w", encoding="utf-8") as f:
-                        f.write(raw_data)
+                    if CACHE_COMPRESS:
+                        sink = gzip.open(tmp_path, "wb", compresslevel=6)
+                    else:
+                        sink = open(tmp_path, "wb")
                 except Exception as e:
                     print(f"Warning: Failed to write cache: {e}")
-
-                if source["format"] in {"json", "aws_json"}:
-                    return _parse_json_prefixes(raw_data, source)
-                else:
+                    buffer = io.BytesIO()
+                    _read_body(response, buffer, cancel)
+                    raw_data = buffer.getvalue().decode("utf-8")
+                    if source["format"] in {"json", "aws_json"}:
+                        return _parse_json_prefixes(raw_data, source)
                     return [
                         line.strip()
                         for line in raw_data.splitlines()
                         if line.strip() and not line.startswith("#")
                     ]
+                try:
+                    with sink:
+                        _read_body(response, sink, cancel)
+                    result = _CachedBody(cache_path, source)
+                    if source["format"] in {"json", "aws_json"}:
+                        result.items = _parse_json_file(tmp_path, source)
+                    with cancel.commit():
+                        # Drop the old validators first: they must never end
+                        # up paired with a different body.
+                        if os.path.exists(_cache_meta_path(cache_path)):
+                            os.remove(_cache_meta_path(cache_path))
+                        os.replace(tmp_path, cache_path)
+                        try:
+                            _write_cache_meta(cache_path, response.headers)
+                        except Exception as e:
+                            print(f"Warning: Failed to write cache metadata: {e}")
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                source["_outcome"] = "fetched"
+                return result
+        except DownloadCancelled:
+            raise
         except Exception as e:
-            if attempt == MAX_RETRIES:
+            # A read cut short by cancel() may surface as a protocol error.
+            cancel.check()
+            if attempt >= MAX_RETRIES:
                 print(
                     f"Error: Failed to download {source['name']} after {MAX_RETRIES} attempts: {e}"
                 )
                 # Fallback: try stale cache within STALE_CACHE_MAX_AGE
-                if os.path.exists(cache_path):
-                    cache_age = time.time() - os.path.getmtime(cache_path)
-                    if cache_age <= STALE_CACHE_MAX_AGE:
-                        stale_data = _parse_cached_data(cache_path, source)
-                        if stale_data:
-                            print(
-                                f"WARNING: Using stale cache for {source['name']} (age: {cache_age / 3600:.1f}h)"
-                            )
-                            return stale_data
-                    else:
-                        print(
-                            f"WARNING: Stale cache for {source['name']} too old ({cache_age / 86400:.1f} days), discarding"
-                        )
-                return None
+                source["_outcome"] = "failed"
+                return _stale_cache_fallback(cache_path, source)
+            delay = RETRY_DELAY * (2 ** (attempt - 1))
             print(
-                f"Attempt {attempt} failed for {source['name']}: {e}. Retrying in {RETRY_DELAY * (2 ** (attempt - 1))}s..."
+                f"Attempt {attempt} failed for {source['name']}: {e}. Retrying in {delay}s..."
             )
-            time.sleep(RETRY_DELAY * (2 ** (attempt - 1)))
+            if scheduled:
+                raise RetryLater(delay) from e
+            time.sleep(delay)
     return None
 
 
+# Second cache tier: each source's collapsed ranges as a flat little-endian
+# uint32 array of (start, end) pairs, valid only for the exact raw bodies and
+# parse options in its key. Bump the magic when normalization changes.
+RANGES_MAGIC = b"BPU-RANGES-1\n"
+
+
+def _ranges_cache_path(source: Source) -> str:
+    return os.path.join(CACHE_DIR, f"{source['name']}.ranges")
+
+
+def _ranges_cache_key(source: Source, bodies: Sequence[Iterable[str]]) -> Optional[str]:
+    """Identify a source's parse input: the raw body hashes (in URL order)
+    plus the options that change what is parsed out of them. None if any body
+    is not a file on disk (static lists, stale-cache parses)."""
+    digests: List[str] = []
+    for body in bodies:
+        if not isinstance(body, _CachedBody):
+            return None
+        try:
+            digests.append(body.digest)
+        except OSError:
+            return None
+    options = {
+        "format": source["format"],
+        "aws_services": sorted(s.upper() for s in source.get("aws_services", [])),
+        "bodies": digests,
+    }
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def load_ranges_cache(source: Source, key: str) -> Optional[List[Tuple[int, int]]]:
+    try:
+        with open(_ranges_cache_path(source), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    header = RANGES_MAGIC + key.encode() + b"\n"
+    if not data.startswith(header):
+        return None
+    _touch_cache(_ranges_cache_path(source))
+    flat = array("I")
+    try:
+        flat.frombytes(data[len(header):])
+    except ValueError:
+        return None
+    if len(flat) % 2:
+        return None
+    if sys.byteorder != "little":
+        flat.byteswap()
+    return list(zip(flat[0::2], flat[1::2]))
+
+
+def save_ranges_cache(source: Source, key: str, ranges: List[Tuple[int, int]]) -> None:
+    flat = array("I", itertools.chain.from_iterable(ranges))
+    if sys.byteorder != "little":
+        flat.byteswap()
+    path = _ranges_cache_path(source)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(RANGES_MAGIC + key.encode() + b"\n")
+            f.write(flat.tobytes())
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Warning: Failed to write ranges cache for {source['name']}: {e}")
+
+
+def collapse_source(
+    source: Source, bodies: Sequence[Iterable[str]], store: bool = True
+) -> List[Tuple[int, int]]:
+    """Collapsed (start, end) ranges of all of a source's bodies.
+
+    Served from the ranges cache when the raw bodies and parse options are
+    unchanged, so warm runs skip parsing, validating and collapsing entirely;
+    otherwise streamed through iter_ranges() / collapse_ranges() and stored
+    (unless `store` is False, as under --plan).
+    """
+    key = _ranges_cache_key(source, bodies)
+    if key is not None:
+        cached = load_ranges_cache(source, key)
+        if cached is not None:
+            return cached
+    collapsed = collapse_ranges(iter_ranges(itertools.chain.from_iterable(bodies)))
+    if key is not None and store:
+        save_ranges_cache(source, key, collapsed)
+    return collapsed
+
+
+FetchResults = List[List[Tuple[str, Optional[Iterable[str]]]]]
+SourceHealth = Dict[str, Dict[str, Any]]
+
+
+def _health_path() -> str:
+    return os.path.join(CACHE_DIR, "health.json")
+
+
+def load_health() -> SourceHealth:
+    """Per-source outcome history from previous runs, keyed by source name:
+    last_success / last_failure (epoch seconds), consecutive_failures and the
+    latest download latencies. Missing or unreadable history starts empty."""
+    try:
+        with open(_health_path(), "r", encoding="utf-8") as f:
+            health = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"WARNING: Ignoring unreadable source health file: {e}")
+        return {}
+    return health if isinstance(health, dict) else {}
+
+
+def save_health(health: SourceHealth, sources: Sequence[Source]) -> None:
+    """Persist `health` for the configured sources (removed ones are dropped)."""
+    names = {src["name"] for src in sources}
+    data = {name: entry for name, entry in health.items() if name in names}
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = _health_path() + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, _health_path())
+
+
+def breaker_state(entry: Optional[Dict[str, Any]], now: float) -> Optional[str]:
+    """'open' (skip the network), 'half-open' (one probe attempt) or None."""
+    if not entry or BREAKER_THRESHOLD <= 0:
+        return None
+    if entry.get("consecutive_failures", 0) < BREAKER_THRESHOLD:
+        return None
+    if now - entry.get("last_failure", 0) < BREAKER_COOLDOWN:
+        return "open"
+    return "half-open"
+
+
+def mean_latency(entry: Optional[Dict[str, Any]]) -> Optional[float]:
+    samples = (entry or {}).get("latency") or []
+    return sum(samples) / len(samples) if samples else None
+
+
+def _record_health(
+    entry: Dict[str, Any], outcomes: Sequence[str], latencies: Sequence[float], now: float
+) -> None:
+    """Fold one run's per-URL outcomes into a source's history. A source
+    fails if any URL failed and succeeds if every URL was fetched or served
+    from fresh cache with at least one real download; pure cache hits say
+    nothing about the upstream and leave the counters alone."""
+    if "failed" in outcomes:
+        entry["consecutive_failures"] = entry.get("consecutive_failures", 0) + 1
+        entry["last_failure"] = now
+    elif "fetched" in outcomes:
+        entry["consecutive_failures"] = 0
+        entry["last_success"] = now
+    if latencies:
+        samples = list(entry.get("latency") or []) + [round(x, 3) for x in latencies]
+        entry["latency"] = samples[-HEALTH_SAMPLES:]
+
+
+def _url_host(url: str) -> str:
+    """Host a URL is fetched from; '' for local files (never rate-capped)."""
+    if not url.startswith("http"):
+        return ""
+    return urllib.parse.urlsplit(url).hostname or ""
+
+
+def source_units(source: Source) -> List[List[str]]:
+    """The independent fetches a source consists of, each as a list of
+    interchangeable URLs. Every "urls" (or "url") entry is its own unit and
+    all of them are unioned; "mirrors" is a single unit of URLs that serve the
+    same list, in order of preference, of which only one has to answer."""
+    units = [[url] for url in source.get("urls", [source.get("url")]) if url]
+    if source.get("mirrors"):
+        units.append(list(source["mirrors"]))
+    return units
+
+
+def fetch_sources(
+    sources: Sequence[Source],
+    force_refresh: bool = False,
+    workers: Optional[int] = None,
+    per_host: Optional[int] = None,
+    deadline: Optional[float] = None,
+    health: Optional[SourceHealth] = None,
+    hedge_delay: Optional[float] = None,
+) -> FetchResults:
+    """Run download_resource() for every fetch unit of every source concurrently.
+
+    Returns, for each source in `sources` order, one (url, result) pair per
+    unit (see source_units()) in the source's own order, so callers aggregate
+    exactly as if the downloads had run one after another. At most `workers`
+    downloads run at once and at most `per_host` of them against the same
+    host; jobs are only dispatched once a host slot is free, so a busy host
+    never parks a worker that another host could use.
+
+    Mirrors are hedged: the next mirror is started if the current one has not
+    answered within `hedge_delay` seconds (default HEDGE_DELAY) or as soon as
+    it fails, and the first good answer settles the unit; slower mirrors are
+    cancelled. A unit none of whose mirrors answered yields the first stale
+    cache among them, in mirror order, or None.
+
+    Retries are scheduled here rather than slept in a worker: a failed attempt
+    re-queues its job after the backoff delay while healthy sources keep
+    downloading. When the absolute `deadline` passes, every unfinished job
+    (queued, backing off or still in flight) is resolved from the stale cache
+    or as failed, and in-flight downloads are cancelled (see CancelToken).
+
+    With a `health` history (see load_health()), it is updated in place from
+    this run's outcomes and drives the circuit breaker: sources whose breaker
+    is open are resolved from the stale cache without touching the network,
+    half-open ones get a single attempt. --force-refresh bypasses the breaker.
+    """
+    if workers is None:
+        workers = FETCH_WORKERS
+    if per_host is None:
+        per_host = FETCH_PER_HOST
+    if hedge_delay is None:
+        hedge_delay = HEDGE_DELAY
+    workers, per_host = max(1, workers), max(1, per_host)
+
+    jobs: List[Tuple[int, str]] = []
+    units: List[List[int]] = []  # job ids of each unit, in mirror order
+    unit_of: List[int] = []
+    for i, src in enumerate(sources):
+        for urls in source_units(src):
+            units.append(list(range(len(jobs), len(jobs) + len(urls))))
+            for url in urls:
+                jobs.append((i, url))
+                unit_of.append(len(units) - 1)
+
+    outcomes: Dict[int, str] = {}
+    latencies: Dict[int, float] = {}
+    connections = HTTPPool()  # closed once the fetch loop below ends
+
+    def run(
+        j: int, attempt: int, offline: Any = False, cancel: Optional[CancelToken] = None
+    ) -> Optional[Iterable[str]]:
+        i, url = jobs[j]
+        # Shallow copy so the per-URL "url" never leaks into SOURCES.
+        temp_src = dict(sources[i])
+        temp_src.update(
+            url=url, _attempt=attempt, _deadline=deadline, _offline=offline,
+            _cancel=cancel, _pool=connections,
+        )
+        started = time.time()
+        result = download_resource(temp_src, force_refresh=force_refresh)
+        outcome = temp_src.get("_outcome")
+        if outcome is None:
+            outcome = "failed" if result is None or offline else "fetched"
+        outcomes[j] = outcome
+        if outcome == "fetched" and not offline:
+            latencies[j] = time.time() - started
+        return result
+
+    done: Dict[int, Optional[Iterable[str]]] = {}
+    settled: Dict[int, Optional[int]] = {}  # unit -> job whose result it uses
+    attempts = [1] * len(jobs)
+    queued: Set[int] = {unit[0] for unit in units}
+    ready = [unit[0] for unit in units]
+    backoff: List[Tuple[float, int]] = []  # heap of (start_at, job): retries, hedges
+    active: Dict[Future, int] = {}
+    cancels: Dict[Future, CancelToken] = {}
+    host_load: Dict[str, int] = {}
+
+    def settle(u: int, winner: Optional[int] = None) -> None:
+        """Close unit `u` with `winner`'s result, or the first stale/partial
+        result among its mirrors, dropping whatever of it is still pending."""
+        if winner is None:
+            winner = next((j for j in units[u] if done.get(j) is not None), None)
+        settled[u] = winner
+        for j in units[u]:
+            if j in ready:
+                ready.remove(j)
+        backoff[:] = [entry for entry in backoff if unit_of[entry[1]] != u]
+        heapq.heapify(backoff)
+        for fut, j in list(active.items()):
+            if unit_of[j] == u:
+                # A losing mirror stops downloading and writes no cache.
+                del active[fut]
+                host_load[_url_host(jobs[j][1])] -= 1
+                fut.cancel()
+                cancels.pop(fut).cancel()
+
+    def hedge(j: int, at: float) -> None:
+        """Start the mirror after job `j` in its unit at `at` (or earlier)."""
+        unit = units[unit_of[j]]
+        k = unit.index(j) + 1
+        if k >= len(unit):
+            return
+        if unit[k] not in queued:
+            queued.add(unit[k])
+            heapq.heappush(backoff, (at, unit[k]))
+            return
+        # Already waiting for its hedge delay: a failure pulls it forward.
+        for n, (start_at, job) in enumerate(backoff):
+            if job == unit[k] and start_at > at and attempts[job] == 1:
+                backoff[n] = (at, job)
+                heapq.heapify(backoff)
+                break
+
+    def resolve_offline(u: int, reason: Any) -> None:
+        for j in units[u]:
+            if j not in done:
+                done[j] = run(j, attempts[j], offline=reason)
+            if done[j] is not None:
+                break
+        settle(u)
+
+    skipped: Set[int] = set()  # sources whose breaker is open
+    if health is not None and not force_refresh:
+        now = time.time()
+        for i, src in enumerate(sources):
+            entry = health.get(src["name"]) or {}
+            state = breaker_state(entry, now)
+            if state is None:
+                continue
+            fails = entry["consecutive_failures"]
+            us = [u for u in range(len(units)) if jobs[units[u][0]][0] == i]
+            if state == "half-open":
+                print(f"  Circuit half-open for {src['name']} ({fails} failed runs): probing once")
+                for u in us:
+                    for j in units[u]:
+                        attempts[j] = MAX_RETRIES
+                continue
+            retry_in = BREAKER_COOLDOWN - (now - entry.get("last_failure", 0))
+            print(
+                f"  Circuit open for {src['name']} ({fails} failed runs): "
+                f"next probe in {retry_in / 60:.0f}m"
+            )
+            skipped.add(i)
+            for u in us:
+                resolve_offline(u, "circuit breaker open")
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while ready or backoff or active:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                break
+            while backoff and backoff[0][0] <= now:
+                ready.append(heapq.heappop(backoff)[1])
+            for j in list(ready):
+                if len(active) >= workers:
+                    break
+                host = _url_host(jobs[j][1])
+                if host and host_load.get(host, 0) >= per_host:
+                    continue
+                ready.remove(j)
+                host_load[host] = host_load.get(host, 0) + 1
+                token = CancelToken()
+                fut = pool.submit(run, j, attempts[j], False, token)
+                active[fut] = j
+                cancels[fut] = token
+                hedge(j, now + hedge_delay)
+
+            timeout: Optional[float] = None
+            if backoff:
+                timeout = max(0.0, backoff[0][0] - now)
+            if deadline is not None:
+                remaining = deadline - now
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            if not active:
+                time.sleep(timeout or 0)
+                continue
+            finished, _ = wait(list(active), timeout=timeout, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                if fut not in active:
+                    continue  # abandoned when its unit settled meanwhile
+                j = active.pop(fut)
+                del cancels[fut]
+                host_load[_url_host(jobs[j][1])] -= 1
+                u = unit_of[j]
+                try:
+                    done[j] = fut.result()
+                except RetryLater as retry:
+                    attempts[j] += 1
+                    heapq.heappush(backoff, (time.time() + retry.delay, j))
+                    hedge(j, time.time())
+                    continue
+                if done[j] is not None and outcomes.get(j) != "failed":
+                    settle(u, j)
+                elif all(k in done for k in units[u]):
+                    settle(u)
+                else:
+                    hedge(j, time.time())
+    finally:
+        # Downloads still in flight at the deadline are cancelled like losing
+        # mirrors: they stop at their next read (or at once, their socket
+        # being shut down) and never commit to the cache, which
+        # resolve_offline() reads next. Cancelled workers are not waited for;
+        # a connect still pending ends at its timeout.
+        for fut in active:
+            cancels[fut].cancel()
+        pool.shutdown(wait=False, cancel_futures=True)
+        # Connections and DNS answers are only shared within one call. A
+        # cancelled worker still holding a connection closes it on release.
+        connections.close()
+
+    unfinished = [u for u in range(len(units)) if u not in settled]
+    if unfinished:
+        print(
+            f"WARNING: Run deadline reached with {len(unfinished)} download(s) "
+            f"unfinished; using cache or fallback for them"
+        )
+        for u in unfinished:
+            resolve_offline(u, True)
+
+    if health is not None:
+        now = time.time()
+        for i, src in enumerate(sources):
+            if i in skipped:
+                continue
+            # A unit is judged by the mirror that settled it, or by every
+            # mirror that was tried when none answered.
+            js: List[int] = []
+            for u, unit in enumerate(units):
+                if jobs[unit[0]][0] != i:
+                    continue
+                winner = settled[u]
+                if winner is not None and outcomes.get(winner) != "failed":
+                    js.append(winner)
+                else:
+                    js.extend(j for j in unit if j in done)
+            if not js:
+                continue
+            entry = health.setdefault(src["name"], {})
+            _record_health(
+                entry,
+                [outcomes.get(j, "failed") for j in js],
+                [latencies[j] for j in js if j in latencies],
+                now,
+            )
+
+    results: FetchResults = [[] for _ in sources]
+    for u, unit in enumerate(units):
+        j = settled[u]
+        if j is None:
+            results[jobs[unit[0]][0]].append((jobs[unit[0]][1], None))
+        else:
+            results[jobs[j][0]].append((jobs[j][1], done[j]))
+    return results
+
+
+def _manifest_path() -> str:
+    return os.path.join(CACHE_DIR, "manifest.json")
+
+
+def _peers_fingerprint(peers_dir: str) -> str:
+    """Hash of the peer configs validate_classes_against_peers() reads."""
+    h = hashlib.sha256()
+    for fn in sorted(glob.glob(os.path.join(peers_dir, "*.conf"))):
+        h.update(os.path.basename(fn).encode() + b"\0")
+        with open(fn, "rb") as f:
+            h.update(f.read())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def build_manifest(
+    sources: Sequence[Source],
+    fetched: FetchResults,
+    aggregation: Optional[Tuple[str, bool, bool]],
+    peers_dir: str,
+    route_budget: Optional[str] = None,
+    split_output: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """Fingerprint of everything the feed is computed from: this script, each
+    source definition and the content hash of each of its bodies, own-infra,
+    the aggregation settings `(spec, explicit, siblings)` (None =
+    --no-aggregate), the --route-budget spec, the --split-output mode and the
+    peer filters they are validated against.
+
+    None when the inputs cannot be pinned down: a source failed (its routes
+    would come from the old feed) or returned a body that is not a file on disk.
+    """
+    manifest: Dict[str, Any] = {
+        "script": file_sha256(os.path.abspath(__file__)),
+        "local_as": LOCAL_AS,
+        "sources": {},
+    }
+    for src, url_results in zip(sources, fetched):
+        digests: List[str] = []
+        for _url, body in url_results:
+            if isinstance(body, _CachedBody):
+                try:
+                    digests.append(body.digest)
+                except OSError:
+                    return None
+            elif body is not None and src.get("static") is not None:
+                digests.append("static")  # covered by the definition hash
+            else:
+                return None
+        definition = json.dumps(src, sort_keys=True, default=str)
+        manifest["sources"][src["name"]] = {
+            "definition": hashlib.sha256(definition.encode()).hexdigest(),
+            "bodies": digests,
+        }
+    try:
+        manifest["own_infra"] = file_sha256(OWN_INFRA_FILE)
+    except OSError:
+        return None
+    manifest["aggregation"] = list(aggregation) if aggregation else None
+    manifest["route_budget"] = route_budget
+    manifest["split_output"] = split_output
+    if aggregation or route_budget:
+        try:
+            manifest["peers"] = _peers_fingerprint(peers_dir)
+        except OSError:
+            return None
+    return manifest
+
+
+def _outputs_fingerprint() -> Dict[str, Optional[List[int]]]:
+    """Size and mtime of the published files, so a feed edited, removed or
+    rewritten behind our back never matches a stored manifest."""
+    stats: Dict[str, Optional[List[int]]] = {}
+    for path in (OUTPUT_BIRD, OUTPUT_TXT, OWN_INFRA_CONF, *split_files()):
+        try:
+            st = os.stat(path)
+            stats[path] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            stats[path] = None
+    return stats
+
+
+def load_manifest() -> Optional[Dict[str, Any]]:
+    try:
+        with open(_manifest_path(), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def manifest_unchanged(manifest: Optional[Dict[str, Any]]) -> bool:
+    """True if `manifest` is what the current feed was last published from."""
+    if manifest is None:
+        return False
+    stored = load_manifest()
+    return (
+        stored is not None
+        and stored.get("inputs") == manifest
+        and stored.get("outputs") == _outputs_fingerprint()
+    )
+
+
+def save_manifest(manifest: Dict[str, Any], routes: int) -> None:
+    """Record that the files on disk are the feed built from `manifest`."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    data = {"inputs": manifest, "outputs": _outputs_fingerprint(), "routes": routes}
+    tmp_path = _manifest_path() + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, sort_keys=True)
+    os.replace(tmp_path, _manifest_path())
+
+
 def check_address_in_sources(target: str, force_refresh: bool = False) -> None:
     """Diagnostic tool to find which source contains a specific IP or CIDR"""
     print(f"\n--- Diagnostic Search for {target} ---")
@@ -819,14 +3006,9 @@ def check_address_in_sources(target: str, force_refresh: bool = False) -> None:
         return
 
     found_any = False
-    for src in SOURCES:
-        urls = src.get("urls", [src.get("url")])
-        for url in urls:
-            if not url:
-                continue
-            temp_src = src.copy()
-            temp_src["url"] = url
-            prefixes = download_resource(temp_src, force_refresh=force_refresh)
+    fetched = fetch_sources(SOURCES, force_refresh=force_refresh)
+    for src, url_results in zip(SOURCES, fetched):
+        for url, prefixes in url_results:
             if prefixes is None:
                 continue
 
@@ -841,9 +3023,7 @@ def check_address_in_sources(target: str, force_refresh: bool = False) -> None:
                             continue
                         p_start, p_end = ip_to_int(parts[0]), ip_to_int(parts[1])
                     else:
-                        p_start, p_end = cidr_to_range(
-                            item if "/" in item else f"{item}/32"
-                        )
+                        p_start, p_end = cidr_to_range(item)
 
                     # Check for overlap
                     if max(t_start, p_start) <= min(t_end, p_end):
@@ -880,7 +3060,7 @@ def check_address_in_sources(target: str, force_refresh: bool = False) -> None:
     print("-" * 40 + "\n")
 
 
-def smoke_test_bird(temp_bird_file: str) -> bool:
+def smoke_test_bird(temp_bird_file: str, staging_dir: Optional[str] = None) -> bool:
     if not os.path.exists(BIRD_CONF):
         print(f"Warning: {BIRD_CONF} not found, skipping smoke test.")
         return True
@@ -900,6 +3080,20 @@ def smoke_test_bird(temp_bird_file: str) -> bool:
 
         check_conf_data = conf_data.replace(old_include_pattern, new_include)
 
+        if staging_dir is not None:
+            # --split-output parts are checked from the staging dir.
+            parts_include = f'include "{os.path.join(PREFIXES_DIR, "*.conf")}";'
+            if parts_include not in conf_data:
+                if os.listdir(staging_dir):
+                    print(
+                        f"ERROR: Could not find '{parts_include}' in {BIRD_CONF}. "
+                        f"--split-output part files would not be loaded."
+                    )
+                    return False
+            check_conf_data = check_conf_data.replace(
+                parts_include, f'include "{os.path.join(staging_dir, "*.conf")}";'
+            )
+
         with open(check_conf, "w", encoding="utf-8") as f:
             f.write(check_conf_data)
 
@@ -958,6 +3152,39 @@ Examples:
         action="store_true",
         help="Disable feed dedup entirely (ship every more-specific).",
     )
+    parser.add_argument(
+        "--aggregate-siblings",
+        action="store_true",
+        help="After dedup, also merge sibling and adjacent routes of the same "
+        "aggregation class into their minimal CIDR cover (needs dedup; skipped "
+        "with it when the classes fail validation).",
+    )
+    parser.add_argument(
+        "--route-budget",
+        type=str,
+        default=None,
+        metavar="LO-HI=N,...",
+        help="Lossy-aggregate each community-suffix class down to at most N "
+        "routes (for peers with a max-prefix limit), adding the least extra "
+        "address space and never covering own-infra. Validated against "
+        "--peers-dir like --aggregate-classes (fail-closed).",
+    )
+    parser.add_argument(
+        "--split-output",
+        choices=("class", "source"),
+        default=None,
+        help=f"Write one `protocol static bgp_prefixes_<part>` file per "
+        f"aggregation class or per source into {PREFIXES_DIR} (glob-included "
+        f"by bird.conf) instead of all routes in one file; only changed parts "
+        f"are rewritten, so BIRD restarts only their protocols.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Compute the new feed and print what would change against the "
+        "current one (added / removed / community-changed routes) without "
+        "writing anything or reloading BIRD.",
+    )
     parser.add_argument(
         "--peers-dir",
         type=str,
@@ -966,6 +3193,8 @@ Examples:
         f"(default {PEERS_DIR}).",
     )
     args = parser.parse_args()
+    if args.aggregate_siblings and args.no_aggregate:
+        parser.error("--aggregate-siblings needs feed dedup; drop --no-aggregate")
 
     if args.check:
         check_address_in_sources(args.check, force_refresh=args.force_refresh)
@@ -978,38 +3207,90 @@ Examples:
     )
     print()
 
-    all_routes: Dict[str, Set[int]] = {}  # CIDR -> set of community suffixes
-    old_routes = parse_old_prefixes(OUTPUT_BIRD)
+    try:
+        registry = CommunityRegistry.from_sources(SOURCES)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    all_routes = RouteTable()
+    old_routes, old_canonical, from_state = load_old_routes(registry, args.split_output)
     failed_communities: Set[int] = set()
     source_stats: List[
         Tuple[str, int, int, str]
     ] = []  # (name, community, count, status)
 
-    for src in SOURCES:
-        urls = src.get("urls", [src.get("url")])
-        all_src_prefixes: List[str] = []
-        any_success = False
+    # Download everything up front (concurrently); aggregation below still
+    # walks SOURCES and each source's URLs in their configured order.
+    health = load_health()
+    fetched = fetch_sources(
+        SOURCES,
+        force_refresh=args.force_refresh,
+        deadline=start_time + RUN_DEADLINE if RUN_DEADLINE > 0 else None,
+        health=health,
+    )
+    # --plan keeps the run out of the persisted state: no health history,
+    # ranges cache, cache GC or manifest (it must also print a plan when the
+    # inputs are unchanged, so it never takes the short-circuit below).
+    if not args.plan:
+        try:
+            save_health(health, SOURCES)
+        except Exception as e:
+            print(f"WARNING: Failed to save source health: {e}")
+
+    # Input-level no-op: if every body, own-infra, the aggregation settings and
+    # peer filters are exactly what the current feed was published from, the
+    # whole pipeline below would reproduce it byte for byte.
+    aggregation: Optional[Tuple[str, bool, bool]] = None
+    if not args.no_aggregate:
+        explicit = args.aggregate_classes is not None
+        aggregation = (
+            args.aggregate_classes if explicit else DEFAULT_AGGREGATE_CLASSES,
+            explicit,
+            args.aggregate_siblings,
+        )
+    manifest: Optional[Dict[str, Any]] = None
+    try:
+        manifest = build_manifest(
+            SOURCES, fetched, aggregation, args.peers_dir, args.route_budget, args.split_output
+        )
+    except Exception as e:
+        print(f"WARNING: Could not fingerprint inputs: {e}")
+    if not args.force_refresh and not args.plan and manifest_unchanged(manifest):
+        try:
+            gc_cache(SOURCES)
+        except Exception as e:
+            print(f"WARNING: Cache GC failed: {e}")
+        stored = load_manifest() or {}
+        print(
+            f"\nResult: No changes (inputs unchanged) | {len(SOURCES)} OK, 0 fallback | "
+            f"Total: {stored.get('routes', '?')} routes | {time.time() - start_time:.1f}s"
+        )
+        return
+
+    for src, url_results in zip(SOURCES, fetched):
+        succeeded: List[Iterable[str]] = []
         failed_urls: List[str] = []
 
-        for url in urls:
-            if not url:
-                continue
-            # Create a shallow copy to safely update the URL for the download function
-            temp_src = src.copy()
-            temp_src["url"] = url
-            result = download_resource(temp_src, force_refresh=args.force_refresh)
+        for url, result in url_results:
             if result is None:
                 failed_urls.append(url)
             else:
-                all_src_prefixes.extend(result)
-                any_success = True
+                succeeded.append(result)
 
-        if not any_success or (failed_urls and src.get("require_all_urls")):
+        collapsed: Optional[List[Tuple[int, int]]] = None
+        if succeeded and not (failed_urls and src.get("require_all_urls")):
+            try:
+                collapsed = collapse_source(src, succeeded, store=not args.plan)
+            except Exception as e:
+                # A body that fails to parse only now (bodies are read lazily)
+                # is treated like a failed download.
+                print(f"  ERROR: Could not parse {src['name']}: {e}")
+
+        if collapsed is None:
             failed_communities.add(src["community_suffix"])
             # Count old routes for this community
-            old_count = sum(
-                1 for comms in old_routes.values() if src["community_suffix"] in comms
-            )
+            bit = registry.bits[src["community_suffix"]]
+            old_count = sum(1 for _, _, comms in old_routes if comms & bit)
             source_stats.append(
                 (src["name"], src["community_suffix"], old_count, "FALLBACK")
             )
@@ -1021,42 +3302,28 @@ Examples:
             for url in failed_urls:
                 print(f"  WARNING: Failed URL (other URLs OK): {url}")
 
-        processed: List[str] = []
-        for item in all_src_prefixes:
-            item = item.strip()
-            if not item:
-                continue
-            if "-" in item:
-                try:
-                    parts = [x.strip() for x in item.split("-")]
-                    if len(parts) != 2:
-                        continue
-                    processed.extend(
-                        range_to_cidrs(ip_to_int(parts[0]), ip_to_int(parts[1]))
-                    )
-                except ValueError:
-                    continue
-            else:
-                processed.append(item if "/" in item else f"{item}/32")
-
-        valid = [p for p in processed if validate_cidr(p)]
-        collapsed = collapse_networks(valid)
+        prefixes = ranges_to_prefixes(collapsed)
+        all_routes.extend(prefixes, registry.bits[src["community_suffix"]])
+        count = len(prefixes)
+        del succeeded, collapsed, prefixes
 
-        source_stats.append(
-            (src["name"], src["community_suffix"], len(collapsed), "OK")
-        )
+        source_stats.append((src["name"], src["community_suffix"], count, "OK"))
 
-        for p in collapsed:
-            all_routes.setdefault(p, set()).add(src["community_suffix"])
+    if not args.plan:
+        try:
+            gc_cache(SOURCES)
+        except Exception as e:
+            print(f"WARNING: Cache GC failed: {e}")
 
     # Restore old routes for failed communities
     if failed_communities:
         restored = 0
-        for cidr, comms in old_routes.items():
-            for comm in comms:
-                if comm in failed_communities:
-                    all_routes.setdefault(cidr, set()).add(comm)
-                    restored += 1
+        failed_mask = registry.mask(failed_communities)
+        for net, plen, comms in old_routes:
+            comms &= failed_mask
+            if comms:
+                all_routes.add(net, plen, comms)
+                restored += bin(comms).count("1")
         print(
             f"\n  Restored {restored} old routes for communities: {sorted(failed_communities)}"
         )
@@ -1067,36 +3334,20 @@ Examples:
     # Regenerate the BIRD OWN_INFRA include from the same inventory (single
     # source of truth for L1 subtraction and L2 export filters). The '+' suffix
     # matches each prefix and all more-specifics.
-    write_own_infra_conf(own_infra)
+    if not args.plan:
+        write_own_infra_conf(own_infra)
     before = len(all_routes)
-    # Count source routes that overlap own-infra BEFORE subtracting. Dict-size
+    # Count source routes that overlap own-infra while subtracting. The size
     # delta is misleading: hole-punching a supernet grows the feed, so it could
     # go negative and silently hide that own-infra was excluded.
-    matched = sum(
-        1
-        for cidr in all_routes
-        if any(ipaddress.IPv4Network(cidr).overlaps(b) for b in own_infra)
-    )
-    all_routes = exclude_own_infra(all_routes, own_infra)
+    own_index = OwnInfraIndex.from_networks(own_infra)
+    all_routes, matched = exclude_own_infra(all_routes, own_index)
     if matched:
         print(
             f"\n  Excluded own-infra: {matched} source route(s) overlapped "
             f"(feed entries {before} -> {len(all_routes)})"
         )
 
-    # Fail-closed: never ship a feed that still overlaps own-infra.
-    leaks = [
-        cidr
-        for cidr in all_routes
-        if any(ipaddress.IPv4Network(cidr).overlaps(b) for b in own_infra)
-    ]
-    if leaks:
-        print(
-            f"\nERROR: {len(leaks)} own-infra prefix(es) survived exclusion "
-            f"(refusing to write feed): {leaks[:5]}"
-        )
-        sys.exit(1)
-
     # Drop more-specifics covered by a supernet in the same feed (cross-source
     # redundancy; collapse_networks only dedups within a source). ON by default
     # with DEFAULT_AGGREGATE_CLASSES — the universal-safe rule drops ~nothing on
@@ -1111,22 +3362,87 @@ Examples:
         classes = parse_class_ranges(spec)
         if validate_classes_against_peers(classes, args.peers_dir, strict=explicit):
             before_dedup = len(all_routes)
-            dropped = dedup_covered_more_specifics(all_routes, classes)
+            class_masks = registry.class_masks(classes)
+            dropped = dedup_covered_more_specifics(all_routes, class_masks)
             print(
                 f"\n  Deduplicated covered more-specifics within "
                 f"{['-'.join(map(str, c)) for c in classes]}: "
                 f"{before_dedup} -> {len(all_routes)} (-{dropped})"
             )
+            if args.aggregate_siblings:
+                before_merge = len(all_routes)
+                all_routes = aggregate_siblings(all_routes, class_masks)
+                print(
+                    f"  Merged sibling/adjacent routes per class: "
+                    f"{before_merge} -> {len(all_routes)} "
+                    f"(-{before_merge - len(all_routes)})"
+                )
+
+    # Lossy per-class aggregation for peers with a max-prefix limit. Merging
+    # routes of different communities is sound only for validated classes,
+    # so the budget classes go through the same check (always strict).
+    if args.route_budget:
+        budgets = parse_route_budgets(args.route_budget)
+        validate_classes_against_peers(
+            [(lo, hi) for lo, hi, _ in budgets], args.peers_dir, strict=True
+        )
+        for (lo, hi, budget), class_mask in zip(
+            budgets, registry.class_masks([(lo, hi) for lo, hi, _ in budgets])
+        ):
+            before_budget = sum(1 for _, _, comms in all_routes if comms & class_mask)
+            all_routes, extra = aggregate_to_budget(all_routes, class_mask, budget, own_index)
+            after_budget = sum(1 for _, _, comms in all_routes if comms & class_mask)
+            print(
+                f"\n  Route budget {lo}-{hi}: {before_budget} -> {after_budget} routes "
+                f"(budget {budget}), over-covering {extra} addresses"
+            )
+            if after_budget > budget:
+                print(
+                    f"WARNING: route budget {budget} for class {lo}-{hi} not reached "
+                    f"({after_budget} routes; the rest carry other classes or "
+                    f"would cover own-infra)."
+                )
+
+    # Fail-closed: never ship a feed that still overlaps own-infra. Checked
+    # after every aggregation pass, since a lossy supernet is new address space,
+    # and against the raw networks rather than own_index, so a bug in the index
+    # that did the exclusion cannot also hide its leak.
+    leaks = own_infra_leaks(all_routes, own_infra)
+    if leaks:
+        print(
+            f"\nERROR: {len(leaks)} own-infra prefix(es) survived exclusion "
+            f"(refusing to write feed): {leaks[:5]}"
+        )
+        sys.exit(1)
 
     # Print summary table
-    print(f"\n{'Source':<25} {'Comm':>4} {'Prefixes':>10} {'Status':<10}")
-    print("-" * 55)
+    print(
+        f"\n{'Source':<25} {'Comm':>4} {'Prefixes':>10} {'Status':<10} "
+        f"{'Last OK':>8} {'Fails':>5} {'Latency':>8}"
+    )
+    print("-" * 78)
+    now = time.time()
     for name, comm, count, status in source_stats:
         status_str = status
         if status == "FALLBACK":
             status_str = "FALLBACK!"
-        print(f"  {name:<23} {comm:>4} {count:>10} {status_str:<10}")
-    print("-" * 55)
+        entry = health.get(name) or {}
+        last_ok = "-"
+        if entry.get("last_success"):
+            age = now - entry["last_success"]
+            if age < 3600:
+                last_ok = f"{age / 60:.0f}m"
+            elif age < 86400:
+                last_ok = f"{age / 3600:.0f}h"
+            else:
+                last_ok = f"{age / 86400:.0f}d"
+        latency = mean_latency(entry)
+        latency_str = f"{latency:.2f}s" if latency is not None else "-"
+        print(
+            f"  {name:<23} {comm:>4} {count:>10} {status_str:<10} "
+            f"{last_ok:>8} {entry.get('consecutive_failures', 0):>5} {latency_str:>8}"
+        )
+    print("-" * 78)
 
     if not all_routes:
         print("\nERROR: No prefixes collected from any source.")
@@ -1134,58 +3450,94 @@ Examples:
 
     # Per-community totals
     comm_totals: Dict[int, int] = {}
-    for comms in all_routes.values():
-        for c in comms:
-            comm_totals[c] = comm_totals.get(c, 0) + 1
+    mask_counts: Dict[int, int] = {}
+    for _, _, comms in all_routes:
+        mask_counts[comms] = mask_counts.get(comms, 0) + 1
+    for comms, n in mask_counts.items():
+        for c in registry.decode(comms):
+            comm_totals[c] = comm_totals.get(c, 0) + n
     print(f"  {'TOTAL':<23} {'':>4} {len(all_routes):>10}")
     print("\nPer-community breakdown:")
     for comm in sorted(comm_totals.keys()):
         print(f"  Community {comm:>3}: {comm_totals[comm]:>10} routes")
 
-    sorted_cidrs = sorted(
-        all_routes.keys(),
-        key=lambda x: (ip_to_int(x.split("/")[0]), int(x.split("/")[1])),
-    )
-
-    txt_content = "\n".join(sorted_cidrs)
-    bird_lines = []
-    for cidr in sorted_cidrs:
-        sorted_comms = sorted(all_routes[cidr])
-        # Correct format: bgp_community.add((ASN, VALUE));
-        # If multiple: { bgp_community.add((ASN, V1)); bgp_community.add((ASN, V2)); }
-        adds = [f"bgp_community.add(({LOCAL_AS}, {suffix}));" for suffix in sorted_comms]
-        bird_lines.append(f"route {cidr} blackhole {{ {' '.join(adds)} }};")
-
-    bird_content = "\n".join(bird_lines)
-
-    # Self-check
-    if "bgp_community.add([(" in bird_content:
-        print(
-            "\nERROR: Invalid community format detected (found 'bgp_community.add([(')."
-        )
-        invalid = [line for line in bird_lines if "bgp_community.add([(" in line]
-        for line in invalid[:5]:
-            print(f"  Invalid line: {line}")
-        sys.exit(1)
-
-    new_hash = hashlib.sha256(bird_content.encode()).hexdigest()
-    old_hash = ""
-    if os.path.exists(OUTPUT_BIRD):
-        with open(OUTPUT_BIRD, "r", encoding="utf-8") as f:
-            old_hash = hashlib.sha256(f.read().encode()).hexdigest()
+    # Structured diff against the feed parsed at startup: one merge over the
+    # sorted keys decides whether anything changed, without rendering or
+    # re-reading the old files.
+    diff = diff_routes(old_routes, all_routes)
+    print(f"\nChanges vs current feed: {diff.summary()}")
+    if args.plan:
+        print_plan(diff, registry)
+        print(f"\nPlan only: feed not written | {time.time() - start_time:.1f}s")
+        return
 
-    txt_hash = hashlib.sha256(txt_content.encode()).hexdigest()
-    old_txt_hash = ""
-    if os.path.exists(OUTPUT_TXT):
-        with open(OUTPUT_TXT, "r", encoding="utf-8") as f:
-            old_txt_hash = hashlib.sha256(f.read().encode()).hexdigest()
+    needs_txt_write = bool(diff.added or diff.removed) or not old_canonical
+    if not needs_txt_write:
+        # Same routes as last time: compare the content, so a hand-edited,
+        # truncated or partly restored prefixes.txt is repaired (size first,
+        # the hash only if the size matches).
+        txt_size, txt_hash = txt_digest(all_routes)
+        try:
+            needs_txt_write = (
+                os.path.getsize(OUTPUT_TXT) != txt_size or file_sha256(OUTPUT_TXT) != txt_hash
+            )
+        except OSError:
+            needs_txt_write = True
+
+    # bird.conf glob-includes PREFIXES_DIR; glibc glob fails on a missing
+    # directory (GLOB_ABORTED) and BIRD refuses the whole config, so it must
+    # exist in single-file mode too.
+    os.makedirs(PREFIXES_DIR, exist_ok=True)
+
+    # --split-output: every part is rendered into a staging dir and only the
+    # files whose content differs from the published one are swapped in, so
+    # `birdc configure` restarts just those protocols. Part files of parts that
+    # are gone (or of a previous split run, in single-file mode) are pruned.
+    staging = PREFIXES_DIR + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    stale_parts = split_files()
+    changed_parts: List[str] = []
+    if args.split_output:
+        split_classes = parse_class_ranges(args.aggregate_classes or DEFAULT_AGGREGATE_CLASSES)
+        part_of = split_part_fn(registry, args.split_output, split_classes, SOURCES)
+        for name, table in sorted(split_routes(all_routes, part_of).items()):
+            filename = f"{SPLIT_FILE_PREFIX}{name}.conf"
+            live = os.path.join(PREFIXES_DIR, filename)
+            digest = write_feed(
+                table, registry, os.path.join(staging, filename), None,
+                protocol=f"bgp_prefixes_{name}",
+            )
+            if live in stale_parts:
+                stale_parts.remove(live)
+            try:
+                unchanged = file_sha256(live) == digest
+            except OSError:
+                unchanged = False
+            if not unchanged:
+                changed_parts.append(filename)
+        # The single-file protocol stays in bird.conf, empty.
+        try:
+            needs_bird_write = os.path.getsize(OUTPUT_BIRD) > 0
+        except OSError:
+            needs_bird_write = True
+    else:
+        needs_bird_write = bool(diff) or not old_canonical
+    split_changed = bool(changed_parts or stale_parts)
 
     elapsed = time.time() - start_time
 
-    needs_bird_write = new_hash != old_hash
-    needs_txt_write = txt_hash != old_txt_hash
-
-    if not needs_bird_write and not needs_txt_write:
+    if not needs_bird_write and not needs_txt_write and not split_changed:
+        shutil.rmtree(staging, ignore_errors=True)
+        if manifest is not None:
+            try:
+                save_manifest(manifest, len(all_routes))
+            except Exception as e:
+                print(f"WARNING: Failed to save input manifest: {e}")
+        if not from_state:
+            try:
+                save_feed_state(all_routes, registry, args.split_output)
+            except Exception as e:
+                print(f"WARNING: Failed to save feed state: {e}")
         failed = sum(1 for _, _, _, s in source_stats if s == "FALLBACK")
         ok = sum(1 for _, _, _, s in source_stats if s == "OK")
         print(
@@ -1196,24 +3548,46 @@ Examples:
 
     # Atomic write with smoke test for BIRD
     temp_bird = OUTPUT_BIRD + ".tmp"
-    os.makedirs(os.path.dirname(OUTPUT_BIRD), exist_ok=True)
-    with open(temp_bird, "w", encoding="utf-8", newline="\n") as f:
-        f.write(bird_content)
-        f.flush()
-        os.fsync(f.fileno())
+    temp_txt = OUTPUT_TXT + ".tmp"
+    if args.split_output:
+        write_feed(RouteTable(), registry, temp_bird, None)
+        new_hash = write_feed(all_routes, registry, None, temp_txt)
+    else:
+        new_hash = write_feed(all_routes, registry, temp_bird, temp_txt)
 
     print("\nRunning smoke test...")
-    if smoke_test_bird(temp_bird):
-        if needs_bird_write:
-            if os.name == "nt" and os.path.exists(OUTPUT_BIRD):
-                os.remove(OUTPUT_BIRD)
-            os.rename(temp_bird, OUTPUT_BIRD)
-        elif os.path.exists(temp_bird):
-            os.remove(temp_bird)
-
-        # Keep prefixes.txt in sync only after the BIRD configuration is valid.
-        if needs_txt_write:
-            atomic_write(OUTPUT_TXT, txt_content)
+    if split_changed or args.split_output:
+        os.makedirs(staging, exist_ok=True)
+        smoke_ok = smoke_test_bird(temp_bird, staging)
+    else:
+        smoke_ok = smoke_test_bird(temp_bird)
+    if smoke_ok:
+        # prefixes.txt is published only after the BIRD configuration is valid.
+        for temp, target, needed in (
+            (temp_bird, OUTPUT_BIRD, needs_bird_write),
+            (temp_txt, OUTPUT_TXT, needs_txt_write),
+        ):
+            if needed:
+                if os.name == "nt" and os.path.exists(target):
+                    os.remove(target)
+                os.rename(temp, target)
+            elif os.path.exists(temp):
+                os.remove(temp)
+        for filename in changed_parts:
+            os.replace(os.path.join(staging, filename), os.path.join(PREFIXES_DIR, filename))
+        for path in stale_parts:
+            os.remove(path)
+        shutil.rmtree(staging, ignore_errors=True)
+        if split_changed:
+            print(
+                f"  Split output: {len(changed_parts)} part file(s) rewritten, "
+                f"{len(stale_parts)} removed in {PREFIXES_DIR}"
+            )
+        if needs_bird_write or split_changed or not from_state:
+            try:
+                save_feed_state(all_routes, registry, args.split_output)
+            except Exception as e:
+                print(f"WARNING: Failed to save feed state: {e}")
 
         # Reload BIRD
         try:
@@ -1223,20 +3597,27 @@ Examples:
             configure_failed = True
         if configure_failed:
             print("WARNING: birdc configure failed. Is BIRD running?")
+        elif manifest is not None:
+            try:
+                save_manifest(manifest, len(all_routes))
+            except Exception as e:
+                print(f"WARNING: Failed to save input manifest: {e}")
 
         elapsed = time.time() - start_time
         failed = sum(1 for _, _, _, s in source_stats if s == "FALLBACK")
         ok = sum(1 for _, _, _, s in source_stats if s == "OK")
         print(
-            f"\nResult: Updated | {ok} OK, {failed} fallback | "
+            f"\nResult: Updated ({diff.summary()}) | {ok} OK, {failed} fallback | "
             f"Total: {len(all_routes)} routes | Hash: {new_hash[:8]} | {elapsed:.1f}s"
         )
     else:
         print(
             "\nERROR: Smoke test failed. New configuration is invalid. Keeping old file."
         )
-        if os.path.exists(temp_bird):
-            os.remove(temp_bird)
+        for temp in (temp_bird, temp_txt):
+            if os.path.exists(temp):
+                os.remove(temp)
+        shutil.rmtree(staging, ignore_errors=True)
         sys.exit(1)
 
 
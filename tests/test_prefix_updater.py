@@ -16,6 +16,13 @@ assert spec.loader is not None
 spec.loader.exec_module(prefix_updater)
 
 
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(monkeypatch: Any, tmp_path: Path) -> None:
+    # main() persists source health in CACHE_DIR; never touch the real one.
+    monkeypatch.setattr(prefix_updater, "CACHE_DIR", str(tmp_path / "prefix-cache"))
+    monkeypatch.setattr(prefix_updater, "PREFIXES_DIR", str(tmp_path / "prefixes.d"))
+
+
 def completed_process(*_args: Any, **_kwargs: Any) -> SimpleNamespace:
     return SimpleNamespace(returncode=0)
 
@@ -26,6 +33,31 @@ def test_validate_cidr_rejects_permissive_ipv4_forms() -> None:
     assert not prefix_updater.validate_cidr("010.000.000.001")
 
 
+@pytest.mark.parametrize(
+    "text",
+    [
+        "192.0.2.0/24", "192.0.2.77/24", "0.0.0.0/0", "255.255.255.255", "10.0.0.1",
+        "1.2.3.4/32", "1.2.3.4/024", "1.2.3.4/255.255.255.0", "1.2.3.4/0.0.0.255",
+        "1.2.3", "1.2.3.4.5", "1.2.3.256", "01.2.3.4", "1.2.3.04/8", "1..3.4",
+        "1.2.3.4/33", "1.2.3.4/", "1.2.3.4/-1", "1.2.3.4/24/8", " 1.2.3.4", "1.2.3.4 ",
+        "\u0661.2.3.4", "1.2.3.+4", "1.2.3.4/ 8", "", "/24", "1.2.3.4/8a",
+    ],
+)
+def test_parse_cidr_matches_ipaddress(text: str) -> None:
+    try:
+        network = ipaddress.IPv4Network(text if "/" in text else f"{text}/32", strict=False)
+        expected: Any = (int(network.network_address), network.prefixlen)
+    except ValueError:
+        expected = ValueError
+    if expected is ValueError:
+        with pytest.raises(ValueError):
+            prefix_updater.parse_cidr(text)
+        assert not prefix_updater.validate_cidr(text)
+    else:
+        assert prefix_updater.parse_cidr(text) == expected
+        assert prefix_updater.format_cidr(*expected) == str(network)
+
+
 def test_cidr_and_range_collapse_still_work() -> None:
     assert prefix_updater.cidr_to_range("192.0.2.0/24") == (
         prefix_updater.ip_to_int("192.0.2.0"),
@@ -95,7 +127,8 @@ def test_aws_json_parser_extracts_filtered_ipv4_prefixes(tmp_path: Path) -> None
         },
     )
 
-    assert prefixes == ["3.10.17.128/25", "13.32.0.0/15"]
+    assert isinstance(prefixes, prefix_updater._CachedBody)
+    assert list(prefixes) == ["3.10.17.128/25", "13.32.0.0/15"]
 
 
 def test_aws_source_is_present_with_cloudfront_filter() -> None:
@@ -136,7 +169,7 @@ def test_aws_json_parser_matches_configured_services_case_insensitively(
         },
     )
 
-    assert prefixes == ["3.10.17.128/25"]
+    assert list(prefixes) == ["3.10.17.128/25"]
 
 
 def test_bird_config_defines_aws_cloudfront_community() -> None:
@@ -229,6 +262,289 @@ def test_main_repairs_missing_txt_when_bird_output_is_unchanged(
     prefix_updater.main()
 
     assert txt_output.read_text(encoding="utf-8") == "192.0.2.0/24"
+    # The snapshot is written too, so the next run skips the text parse.
+    assert prefix_updater.load_old_routes(
+        prefix_updater.CommunityRegistry([100])
+    )[2]
+
+    # A truncated prefixes.txt newer than prefixes.bird is repaired as well.
+    txt_output.write_text("192.0.2.0/2", encoding="utf-8")
+    prefix_updater.main()
+    assert txt_output.read_text(encoding="utf-8") == "192.0.2.0/24"
+
+
+def test_main_plan_prints_diff_without_writing(
+    monkeypatch: Any, tmp_path: Path, capsys: Any
+) -> None:
+    bird_output = tmp_path / "prefixes.bird"
+    old_feed = (
+        "route 192.0.2.0/24 blackhole { bgp_community.add((64888, 100)); };\n"
+        "route 198.51.100.0/24 blackhole { bgp_community.add((64888, 100)); };"
+    )
+    bird_output.write_text(old_feed, encoding="utf-8")
+    monkeypatch.setattr(prefix_updater, "OUTPUT_BIRD", str(bird_output))
+    monkeypatch.setattr(prefix_updater, "OUTPUT_TXT", str(tmp_path / "prefixes.txt"))
+    monkeypatch.setattr(
+        prefix_updater,
+        "SOURCES",
+        [
+            {
+                "name": "test_source",
+                "url": "https://example.test/prefixes.txt",
+                "community_suffix": 100,
+                "format": "text",
+            }
+        ],
+    )
+    monkeypatch.setattr(
+        prefix_updater,
+        "download_resource",
+        lambda source, force_refresh=False: ["192.0.2.0/24", "203.0.113.0/25"],
+    )
+    own_file = tmp_path / "own-infra.lst"
+    own_file.write_text("10.255.0.0/24\n", encoding="utf-8")
+    monkeypatch.setattr(prefix_updater, "OWN_INFRA_FILE", str(own_file))
+    monkeypatch.setattr(prefix_updater, "OWN_INFRA_CONF", str(own_file) + ".conf")
+    monkeypatch.setattr(prefix_updater.sys, "argv", ["prefix_updater.py", "--plan"])
+
+    prefix_updater.main()
+
+    out = capsys.readouterr().out
+    assert "Changes vs current feed: +1 -1 ~0 (community)" in out
+    assert "+ 203.0.113.0/25" in out
+    assert "- 198.51.100.0/24" in out
+    assert bird_output.read_text(encoding="utf-8") == old_feed
+    assert not (tmp_path / "prefixes.txt").exists()
+    assert not (tmp_path / "own-infra.lst.conf").exists()
+    # No health history, ranges cache or manifest either.
+    cache_dir = Path(prefix_updater.CACHE_DIR)
+    assert not cache_dir.exists() or not list(cache_dir.iterdir())
+
+    # Unchanged inputs still print a plan instead of short-circuiting, and
+    # the cache is not garbage-collected.
+    monkeypatch.setattr(prefix_updater, "manifest_unchanged", lambda manifest: True)
+    monkeypatch.setattr(
+        prefix_updater, "gc_cache", lambda *args: pytest.fail("--plan must not GC the cache")
+    )
+    prefix_updater.main()
+    out = capsys.readouterr().out
+    assert "inputs unchanged" not in out
+    assert "+ 203.0.113.0/25" in out
+
+
+def test_diff_routes_and_canonical_old_feed(tmp_path: Path) -> None:
+    old = _routes({"10.0.0.0/24": {100}, "10.0.1.0/24": {200}, "10.0.2.0/24": {300}})
+    new = _routes({"10.0.0.0/24": {100}, "10.0.1.0/24": {200, 210}, "10.0.3.0/24": {300}})
+    diff = prefix_updater.diff_routes(old, new)
+    assert diff.summary() == "+1 -1 ~1 (community)"
+    assert not prefix_updater.diff_routes(new, new)
+
+    bird = tmp_path / "prefixes.bird"
+    canonical = (
+        "route 10.0.0.0/24 blackhole { bgp_community.add((64888, 100)); };\n"
+        "route 10.0.1.0/24 blackhole { bgp_community.add((64888, 200)); "
+        "bgp_community.add((64888, 210)); };"
+    )
+    for text, expected in (
+        (canonical, True),
+        (canonical + "\n", False),                          # trailing newline
+        ("\n".join(reversed(canonical.split("\n"))), False),  # unsorted
+        (canonical.replace("64888, 100", "65000, 100"), False),  # other AS
+    ):
+        bird.write_text(text, encoding="utf-8")
+        table, is_canonical = prefix_updater.parse_old_prefixes(str(bird), _COMMUNITIES)
+        assert is_canonical is expected, text
+        assert len(table) == 2
+
+
+def test_write_feed_streams_both_outputs_and_hashes_bird(
+    monkeypatch: Any, tmp_path: Path
+) -> None:
+    import hashlib
+
+    routes = _routes({"10.0.1.0/24": {200, 210}, "10.0.0.0/24": {100}})
+    bird, txt = tmp_path / "out" / "prefixes.bird.tmp", tmp_path / "prefixes.txt.tmp"
+    digest = prefix_updater.write_feed(routes, _COMMUNITIES, str(bird), str(txt))
+
+    assert txt.read_text(encoding="utf-8") == "10.0.0.0/24\n10.0.1.0/24"
+    assert digest == hashlib.sha256(bird.read_bytes()).hexdigest()
+    table, canonical = prefix_updater.parse_old_prefixes(str(bird), _COMMUNITIES)
+    assert canonical and list(table) == list(routes)
+
+    monkeypatch.setattr(
+        prefix_updater, "route_action", lambda registry, mask: "{ bgp_community.add([(1, 2)]); };"
+    )
+    with pytest.raises(SystemExit):
+        prefix_updater.write_feed(routes, _COMMUNITIES, str(bird), str(txt))
+    assert not bird.exists() and not txt.exists()
+
+
+def test_feed_state_round_trip_staleness_and_remap(monkeypatch: Any, tmp_path: Path) -> None:
+    bird = tmp_path / "prefixes.bird"
+    monkeypatch.setattr(prefix_updater, "OUTPUT_BIRD", str(bird))
+    routes = _routes({"10.0.0.0/24": {100}, "10.0.1.0/24": {200, 384}})
+    prefix_updater.write_feed(routes, _COMMUNITIES, str(bird), str(tmp_path / "t"))
+    prefix_updater.save_feed_state(routes, _COMMUNITIES)
+
+    table, canonical, from_state = prefix_updater.load_old_routes(_COMMUNITIES)
+    assert from_state and canonical and list(table) == list(routes)
+
+    # Sources changed: 384 has no bit any more -> dropped, not canonical.
+    fewer = prefix_updater.CommunityRegistry([100, 200])
+    table, canonical = prefix_updater.load_feed_state(fewer)
+    assert not canonical
+    assert [(net, plen, fewer.decode(mask)) for net, plen, mask in table] == [
+        (0x0A000000, 24, [100]),
+        (0x0A000100, 24, [200]),
+    ]
+
+    # Corrupt snapshot -> ignored; edited feed -> stale, text parse instead.
+    state = Path(str(bird) + ".state")
+    state.write_bytes(state.read_bytes()[:-1] + b"x")
+    assert prefix_updater.load_feed_state(_COMMUNITIES) is None
+    prefix_updater.save_feed_state(routes, _COMMUNITIES)
+    bird.write_text(bird.read_text(encoding="utf-8") + "\n", encoding="utf-8")
+    table, canonical, from_state = prefix_updater.load_old_routes(_COMMUNITIES)
+    assert not from_state and not canonical and len(table) == 2
+
+    # Same-size edit with the mtime kept (cp -p, rsync -t) -> stale too.
+    import os
+
+    bird.write_text(bird.read_text(encoding="utf-8").rstrip("\n"), encoding="utf-8")
+    prefix_updater.save_feed_state(routes, _COMMUNITIES)
+    st = bird.stat()
+    bird.write_text(bird.read_text(encoding="utf-8").replace("10.0.1.0", "10.0.9.0"), encoding="utf-8")
+    os.utime(bird, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert prefix_updater.load_feed_state(_COMMUNITIES) is None
+    table, _canonical, from_state = prefix_updater.load_old_routes(_COMMUNITIES)
+    assert not from_state and (0x0A000900, 24) in [(net, plen) for net, plen, _ in table]
+
+
+def test_split_part_fn_by_class_and_source() -> None:
+    routes = _routes({
+        "10.0.0.0/24": {100, 110},
+        "10.0.1.0/24": {200},
+        "10.0.2.0/24": {100, 200},
+        "10.0.3.0/24": {384},
+    })
+    by_class = prefix_updater.split_part_fn(_COMMUNITIES, "class", [(100, 199), (200, 299)], [])
+    parts = prefix_updater.split_routes(routes, by_class)
+    assert {name: _as_text(table) for name, table in parts.items()} == {
+        "100_199": {"10.0.0.0/24": {100, 110}},
+        "200_299": {"10.0.1.0/24": {200}},
+        "mixed": {"10.0.2.0/24": {100, 200}},
+        "other": {"10.0.3.0/24": {384}},
+    }
+
+    sources = [
+        {"name": f"src{c}", "community_suffix": c} for c in _COMMUNITIES.suffixes
+    ]
+    by_source = prefix_updater.split_part_fn(_COMMUNITIES, "source", [], sources)
+    assert by_source(_COMMUNITIES.mask([200])) == "src200"
+    assert by_source(_COMMUNITIES.mask([100, 110])) == "mixed"
+
+
+def test_main_split_output_rewrites_only_changed_parts(
+    monkeypatch: Any, tmp_path: Path
+) -> None:
+    bird_output = tmp_path / "prefixes.bird"
+    parts_dir = tmp_path / "prefixes.d"
+    monkeypatch.setattr(prefix_updater, "OUTPUT_BIRD", str(bird_output))
+    monkeypatch.setattr(prefix_updater, "OUTPUT_TXT", str(tmp_path / "prefixes.txt"))
+    monkeypatch.setattr(
+        prefix_updater,
+        "SOURCES",
+        [
+            {"name": "ru", "url": "https://example.test/ru.txt", "community_suffix": 100, "format": "text"},
+            {"name": "cdn", "url": "https://example.test/cdn.txt", "community_suffix": 200, "format": "text"},
+        ],
+    )
+    feeds = {"ru": ["192.0.2.0/24"], "cdn": ["198.51.100.0/24"]}
+    monkeypatch.setattr(
+        prefix_updater,
+        "download_resource",
+        lambda source, force_refresh=False: list(feeds[source["name"]]),
+    )
+    own_file = tmp_path / "own-infra.lst"
+    own_file.write_text("203.0.113.0/24\n", encoding="utf-8")
+    monkeypatch.setattr(prefix_updater, "OWN_INFRA_FILE", str(own_file))
+    monkeypatch.setattr(prefix_updater, "OWN_INFRA_CONF", str(own_file) + ".conf")
+    staged = []
+    monkeypatch.setattr(
+        prefix_updater,
+        "smoke_test_bird",
+        lambda temp_bird_file, staging_dir=None: staged.append(staging_dir) or True,
+    )
+    monkeypatch.setattr(prefix_updater.subprocess, "run", completed_process)
+    argv = ["prefix_updater.py", "--no-aggregate", "--split-output", "source"]
+    monkeypatch.setattr(prefix_updater.sys, "argv", argv)
+
+    prefix_updater.main()
+
+    ru, cdn = parts_dir / "bgp_prefixes_ru.conf", parts_dir / "bgp_prefixes_cdn.conf"
+    assert bird_output.read_text(encoding="utf-8") == ""
+    assert "protocol static bgp_prefixes_cdn {" in cdn.read_text(encoding="utf-8")
+    assert (
+        "    route 192.0.2.0/24 blackhole { bgp_community.add((64888, 100)); };"
+        in ru.read_text(encoding="utf-8")
+    )
+    assert (tmp_path / "prefixes.txt").read_text(encoding="utf-8") == (
+        "192.0.2.0/24\n198.51.100.0/24"
+    )
+    assert staged and not Path(staged[0]).exists()
+
+    # Only the part whose routes changed is rewritten.
+    ru_mtime = ru.stat().st_mtime_ns
+    feeds["cdn"].append("198.51.102.0/24")
+    prefix_updater.main()
+    assert ru.stat().st_mtime_ns == ru_mtime
+    assert "route 198.51.102.0/24" in cdn.read_text(encoding="utf-8")
+
+    # Back to one file: the feed moves into prefixes.bird, the parts go.
+    monkeypatch.setattr(prefix_updater.sys, "argv", argv[:2])
+    prefix_updater.main()
+    assert not list(parts_dir.glob("*.conf"))
+    table, canonical = prefix_updater.parse_old_prefixes(
+        str(bird_output), prefix_updater.CommunityRegistry([100, 200])
+    )
+    assert canonical and len(table) == 3
+
+
+def test_main_creates_prefixes_dir_before_smoke_test_without_split(
+    monkeypatch: Any, tmp_path: Path
+) -> None:
+    # bird.conf glob-includes PREFIXES_DIR; BIRD rejects the config if the
+    # directory is missing, so the single-file path must create it too.
+    parts_dir = tmp_path / "prefixes.d"
+    bird_output = tmp_path / "prefixes.bird"
+    monkeypatch.setattr(prefix_updater, "OUTPUT_BIRD", str(bird_output))
+    monkeypatch.setattr(prefix_updater, "OUTPUT_TXT", str(tmp_path / "prefixes.txt"))
+    monkeypatch.setattr(
+        prefix_updater,
+        "SOURCES",
+        [{"name": "ru", "url": "https://example.test/ru.txt", "community_suffix": 100, "format": "text"}],
+    )
+    monkeypatch.setattr(
+        prefix_updater, "download_resource", lambda source, force_refresh=False: ["192.0.2.0/24"]
+    )
+    own_file = tmp_path / "own-infra.lst"
+    own_file.write_text("203.0.113.0/24\n", encoding="utf-8")
+    monkeypatch.setattr(prefix_updater, "OWN_INFRA_FILE", str(own_file))
+    monkeypatch.setattr(prefix_updater, "OWN_INFRA_CONF", str(own_file) + ".conf")
+    seen = []
+    monkeypatch.setattr(
+        prefix_updater,
+        "smoke_test_bird",
+        lambda temp_bird_file: seen.append(parts_dir.is_dir()) or True,
+    )
+    monkeypatch.setattr(prefix_updater.subprocess, "run", completed_process)
+    monkeypatch.setattr(prefix_updater.sys, "argv", ["prefix_updater.py"])
+    assert not parts_dir.exists()
+
+    prefix_updater.main()
+
+    assert seen == [True]
+    assert bird_output.exists() and not list(parts_dir.iterdir())
 
 
 def test_main_deduplicates_duplicate_aws_prefixes(monkeypatch: Any, tmp_path: Path) -> None:
@@ -330,22 +646,40 @@ def _own(*cidrs: str) -> list:
     return [ipaddress.ip_network(c) for c in cidrs]
 
 
+_COMMUNITIES = prefix_updater.CommunityRegistry([100, 110, 200, 210, 300, 384])
+
+
+def _routes(mapping: dict[str, set[int]]) -> Any:
+    """Pipeline route table from a {CIDR: communities} literal."""
+    table = prefix_updater.RouteTable()
+    for cidr, comms in mapping.items():
+        table.add(*prefix_updater.parse_cidr(cidr), _COMMUNITIES.mask(comms))
+    return table
+
+
+def _as_text(routes: Any) -> dict[str, set[int]]:
+    return {
+        prefix_updater.format_cidr(net, plen): set(_COMMUNITIES.decode(comms))
+        for net, plen, comms in routes
+    }
+
+
 def test_exclude_own_infra_drops_exact_match() -> None:
     own = _own("10.20.42.0/23")
-    result = prefix_updater.exclude_own_infra({"10.20.42.0/23": {100}}, own)
+    result = _as_text(prefix_updater.exclude_own_infra(_routes({"10.20.42.0/23": {100}}), own)[0])
     assert result == {}
 
 
 def test_exclude_own_infra_drops_more_specific() -> None:
     own = _own("10.20.42.0/23")
     # /25 inside the own /23 must vanish entirely
-    result = prefix_updater.exclude_own_infra({"10.20.42.128/25": {100}}, own)
+    result = _as_text(prefix_updater.exclude_own_infra(_routes({"10.20.42.128/25": {100}}), own)[0])
     assert result == {}
 
 
 def test_exclude_own_infra_hole_punches_supernet() -> None:
     own = _own("10.20.42.0/23")
-    result = prefix_updater.exclude_own_infra({"10.20.0.0/16": {100, 200}}, own)
+    result = _as_text(prefix_updater.exclude_own_infra(_routes({"10.20.0.0/16": {100, 200}}), own)[0])
     # No remaining prefix may overlap the own block...
     own_net = own[0]
     assert all(not ipaddress.ip_network(c).overlaps(own_net) for c in result)
@@ -359,7 +693,7 @@ def test_exclude_own_infra_hole_punches_supernet() -> None:
 def test_exclude_own_infra_keeps_disjoint_prefix() -> None:
     own = _own("10.20.42.0/23")
     routes = {"8.8.8.0/24": {300}}
-    assert prefix_updater.exclude_own_infra(routes, own) == {"8.8.8.0/24": {300}}
+    assert _as_text(prefix_updater.exclude_own_infra(_routes(routes), own)[0]) == {"8.8.8.0/24": {300}}
 
 
 def test_exclude_own_infra_merges_duplicate_remainders() -> None:
@@ -367,10 +701,60 @@ def test_exclude_own_infra_merges_duplicate_remainders() -> None:
     # have their community sets merged, not overwritten.
     own = _own("10.0.0.0/24")
     routes = {"10.0.0.0/23": {100}, "10.0.1.0/24": {200}}
-    result = prefix_updater.exclude_own_infra(routes, own)
+    result = _as_text(prefix_updater.exclude_own_infra(_routes(routes), own)[0])
     assert result == {"10.0.1.0/24": {100, 200}}
 
 
+def test_exclude_own_infra_hole_punch_matches_address_exclude() -> None:
+    route = ipaddress.ip_network("10.0.0.0/8")
+    for own_cidr in ("10.0.0.0/9", "10.255.255.255/32", "10.42.16.0/20", "10.128.0.0/24"):
+        own = _own(own_cidr)
+        expected = {str(n): {100} for n in route.address_exclude(own[0])}
+        assert _as_text(prefix_updater.exclude_own_infra(_routes({str(route): {100}}), own)[0]) == expected
+
+
+def test_own_infra_index_and_leak_check_agree_with_ipaddress() -> None:
+    import random
+
+    rng = random.Random(7)
+
+    def random_net(lo: int, hi: int) -> ipaddress.IPv4Network:
+        plen = rng.randint(lo, hi)
+        return ipaddress.ip_network((0x0A000000 | rng.getrandbits(24), plen), strict=False)
+
+    def spans(nets: Any) -> list[tuple[int, int]]:
+        return prefix_updater.collapse_ranges(
+            (int(n.network_address), int(n.broadcast_address)) for n in nets
+        )
+
+    for _ in range(300):
+        own = sorted({random_net(12, 28) for _ in range(rng.randint(1, 6))})
+        route = random_net(8, 24)
+        overlaps = any(route.overlaps(block) for block in own)
+        index = prefix_updater.OwnInfraIndex.from_networks(own)
+        assert index.overlaps(int(route.network_address), route.prefixlen) == overlaps
+
+        # Reference remainder: address_exclude() every own block in turn.
+        remaining = [route]
+        for block in own:
+            remaining = [
+                part
+                for r in remaining
+                for part in (
+                    r.address_exclude(block) if block.subnet_of(r)
+                    else [] if r.subnet_of(block) else [r]
+                )
+            ]
+        table = _routes({str(route): {100}})
+        got = prefix_updater.exclude_own_infra(table, own)[0]
+        got_nets = [ipaddress.ip_network(c) for c in _as_text(got)]
+        assert spans(got_nets) == spans(remaining)
+
+        # The final leak check does not use the index, yet agrees with it.
+        assert prefix_updater.own_infra_leaks(got, own) == []
+        assert prefix_updater.own_infra_leaks(table, own) == ([str(route)] if overlaps else [])
+
+
 def test_load_own_infra_fatal_when_file_missing(tmp_path: Path) -> None:
     # No hard-coded defaults (public repo): refuse to publish without inventory.
     missing = tmp_path / "nope.lst"
@@ -459,6 +843,14 @@ def test_main_excludes_own_infra_from_feed(monkeypatch: Any, tmp_path: Path) ->
     assert "8.8.8.0/24" in out
     assert "10.20.42" not in txt_output.read_text(encoding="utf-8")
 
+    # A broken index that lets the own /24 through is caught by the final,
+    # index-independent leak check: nothing is written.
+    bird_output.unlink()
+    monkeypatch.setattr(prefix_updater.OwnInfraIndex, "overlaps", lambda self, net, plen: False)
+    with pytest.raises(SystemExit):
+        prefix_updater.main()
+    assert not bird_output.exists()
+
 
 def test_main_logs_own_infra_exclusion_even_when_holepunch_grows_feed(
     monkeypatch: Any, tmp_path: Path, capsys: Any
@@ -550,62 +942,83 @@ def test_main_excludes_own_infra_restored_from_old_feed(
 
 
 def test_dedup_drops_more_specific_when_supernet_community_superset() -> None:
-    routes = {
+    routes = _routes({
         "10.0.0.0/24": {200},
         "10.0.0.5/32": {200},          # covered, same community -> drop
         "10.0.0.7/32": {200, 384},     # covered but {200,384} ⊄ {200} -> keep
-    }
+    })
     dropped = prefix_updater.dedup_covered_more_specifics(routes)
     assert dropped == 1
-    assert "10.0.0.5/32" not in routes
-    assert "10.0.0.0/24" in routes
-    assert "10.0.0.7/32" in routes
+    assert "10.0.0.5/32" not in _as_text(routes)
+    assert "10.0.0.0/24" in _as_text(routes)
+    assert "10.0.0.7/32" in _as_text(routes)
 
 
 def test_dedup_keeps_more_specific_when_supernet_has_different_community() -> None:
-    routes = {
+    routes = _routes({
         "10.0.0.0/24": {384},          # CDN block
         "10.0.0.5/32": {200},          # RKN host inside it; {200} ⊄ {384} -> keep
-    }
+    })
     dropped = prefix_updater.dedup_covered_more_specifics(routes)
     assert dropped == 0
-    assert "10.0.0.5/32" in routes
+    assert "10.0.0.5/32" in _as_text(routes)
 
 
 def test_dedup_drops_when_supernet_is_strict_superset() -> None:
-    routes = {
+    routes = _routes({
         "10.0.0.0/24": {200, 384},
         "10.0.0.5/32": {200},          # {200} ⊆ {200,384} -> drop
-    }
+    })
     dropped = prefix_updater.dedup_covered_more_specifics(routes)
     assert dropped == 1
-    assert "10.0.0.5/32" not in routes
+    assert "10.0.0.5/32" not in _as_text(routes)
 
 
 def test_dedup_ignores_disjoint_and_equal_prefixes() -> None:
-    routes = {
+    routes = _routes({
         "10.0.0.0/24": {200},
         "10.1.0.0/24": {200},          # disjoint, equal length -> keep
         "10.2.0.0/24": {200, 384},     # disjoint, different comms -> keep
-    }
+    })
     dropped = prefix_updater.dedup_covered_more_specifics(routes)
     assert dropped == 0
     assert len(routes) == 3
 
 
 def test_dedup_handles_multi_level_nesting() -> None:
-    routes = {
+    routes = _routes({
         "10.0.0.0/16": {200},
         "10.0.0.0/24": {200},          # covered by /16 -> drop
         "10.0.0.5/32": {200},          # covered by /16 (and /24) -> drop
-    }
+    })
     dropped = prefix_updater.dedup_covered_more_specifics(routes)
     assert dropped == 2
-    assert set(routes) == {"10.0.0.0/16"}
+    assert set(_as_text(routes)) == {"10.0.0.0/16"}
+
+
+def test_dedup_needs_one_supernet_carrying_every_class() -> None:
+    # {200, 384} is covered by the /16 {200} and the /24 {384} together, but
+    # neither supernet alone carries both -> keep.
+    routes = _routes({
+        "10.0.0.0/16": {200},
+        "10.0.0.0/24": {384},
+        "10.0.0.5/32": {200, 384},
+    })
+    assert prefix_updater.dedup_covered_more_specifics(routes) == 0
+    assert len(routes) == 3
+
+
+def test_covering_parents() -> None:
+    keys = sorted(prefix_updater.parse_cidr(c) for c in (
+        "10.0.0.0/8", "10.1.0.0/16", "10.1.2.0/24", "10.2.0.0/16", "192.0.2.0/24",
+    ))
+    assert prefix_updater.covering_parents(keys) == [-1, 0, 1, 0, -1]
+    with pytest.raises(ValueError):
+        prefix_updater.covering_parents(list(reversed(keys)))
 
 
 def test_dedup_is_idempotent() -> None:
-    routes = {"10.0.0.0/24": {200}, "10.0.0.5/32": {200}}
+    routes = _routes({"10.0.0.0/24": {200}, "10.0.0.5/32": {200}})
     prefix_updater.dedup_covered_more_specifics(routes)
     second = prefix_updater.dedup_covered_more_specifics(routes)
     assert second == 0
@@ -613,35 +1026,114 @@ def test_dedup_is_idempotent() -> None:
 
 def test_dedup_classes_collapse_within_a_range() -> None:
     # 200 (RKN) under 300 (services): different communities, same class -> drop.
-    routes = {
+    routes = _routes({
         "10.0.0.0/24": {300},
         "10.0.0.5/32": {200},
-    }
+    })
     dropped = prefix_updater.dedup_covered_more_specifics(
-        routes, classes=[(200, 399)]
+        routes, class_masks=_COMMUNITIES.class_masks([(200, 399)])
     )
     assert dropped == 1
-    assert "10.0.0.5/32" not in routes
+    assert "10.0.0.5/32" not in _as_text(routes)
 
 
 def test_dedup_classes_keep_across_class_boundary() -> None:
     # 200 (BLOCKED class) under 100 (RU class): different classes -> keep.
-    routes = {
+    routes = _routes({
         "10.0.0.0/24": {100},
         "10.0.0.5/32": {200},
-    }
+    })
     dropped = prefix_updater.dedup_covered_more_specifics(
-        routes, classes=[(100, 199), (200, 399)]
+        routes, class_masks=_COMMUNITIES.class_masks([(100, 199), (200, 399)])
     )
     assert dropped == 0
-    assert "10.0.0.5/32" in routes
+    assert "10.0.0.5/32" in _as_text(routes)
 
 
 def test_dedup_empty_classes_matches_exact_superset() -> None:
     # No classes -> only exact community superset drops (universal-safe).
-    routes = {"10.0.0.0/24": {300}, "10.0.0.5/32": {200}}
+    routes = _routes({"10.0.0.0/24": {300}, "10.0.0.5/32": {200}})
     assert prefix_updater.dedup_covered_more_specifics(routes) == 0
-    assert "10.0.0.5/32" in routes
+    assert "10.0.0.5/32" in _as_text(routes)
+
+
+def test_aggregate_siblings_merges_within_a_class_only() -> None:
+    routes = _routes({
+        "10.0.0.0/24": {200},          # blocked_ip
+        "10.0.1.0/24": {210},          # rkn_subnets: same class -> one /23
+        "10.0.2.0/24": {100},          # RU class: adjacent but not merged
+        "10.0.3.0/25": {300},
+        "10.0.3.128/25": {384},        # services siblings -> one /24
+    })
+    merged = prefix_updater.aggregate_siblings(
+        routes, _COMMUNITIES.class_masks([(100, 199), (200, 399)])
+    )
+    assert _as_text(merged) == {
+        "10.0.0.0/23": {200, 210},
+        "10.0.2.0/24": {100},
+        "10.0.3.0/24": {300, 384},
+    }
+
+
+def test_aggregate_to_budget_takes_cheapest_supernet_and_avoids_own_infra() -> None:
+    feed = {
+        "10.0.0.0/24": {200},
+        "10.0.2.0/24": {210},
+        "10.0.3.0/24": {200},          # lossless: 10.0.2.0/23
+        "10.0.8.0/24": {300},
+        "10.0.16.0/24": {100},         # other class: untouched
+    }
+    class_mask = _COMMUNITIES.class_masks([(200, 399)])[0]
+
+    merged, extra = prefix_updater.aggregate_to_budget(
+        _routes(feed), class_mask, 2, prefix_updater.OwnInfraIndex([])
+    )
+    assert _as_text(merged) == {
+        "10.0.0.0/22": {200, 210},     # +256 addresses beats the /20 (+3072)
+        "10.0.8.0/24": {300},
+        "10.0.16.0/24": {100},
+    }
+    assert extra == 256
+
+    own = prefix_updater.OwnInfraIndex([prefix_updater.cidr_to_range("10.0.1.0/24")])
+    merged, extra = prefix_updater.aggregate_to_budget(_routes(feed), class_mask, 2, own)
+    assert len(merged) == 4 and extra == 0  # every supernet would cover own-infra
+
+
+def test_aggregate_to_budget_counts_over_coverage_from_class_span() -> None:
+    class_mask = _COMMUNITIES.class_masks([(200, 399)])[0]
+    # The /22 supernet of the two /24s is already announced with 200 by a
+    # route that also carries another class: merging adds no addresses.
+    feed = {
+        "10.0.0.0/22": {100, 200},
+        "10.0.0.0/24": {200},
+        "10.0.2.0/24": {210},
+        "10.0.16.0/24": {300},
+    }
+    merged, extra = prefix_updater.aggregate_to_budget(
+        _routes(feed), class_mask, 3, prefix_updater.OwnInfraIndex([])
+    )
+    assert _as_text(merged) == {
+        "10.0.0.0/22": {100, 200, 210},
+        "10.0.16.0/24": {300},
+    }
+    assert extra == 0
+
+    # Without that route the same merge over-covers the two unused /24s.
+    del feed["10.0.0.0/22"]
+    merged, extra = prefix_updater.aggregate_to_budget(
+        _routes(feed), class_mask, 2, prefix_updater.OwnInfraIndex([])
+    )
+    assert "10.0.0.0/22" in _as_text(merged) and extra == 512
+
+
+def test_parse_route_budgets() -> None:
+    assert prefix_updater.parse_route_budgets("200-399=50000, 100-199=20000") == [
+        (200, 399, 50000),
+        (100, 199, 20000),
+    ]
+    with pytest.raises(SystemExit):
+        prefix_updater.parse_route_budgets("200-399=0")
 
 
 def test_parse_class_ranges_valid() -> None:
@@ -759,16 +1251,44 @@ def test_validate_classes_nonstrict_ok_returns_true(tmp_path: Any) -> None:
     )
 
 
+def test_community_registry_masks_and_classes() -> None:
+    registry = prefix_updater.CommunityRegistry([300, 100, 200, 384, 200])
+    assert registry.suffixes == [100, 200, 300, 384]
+    mask = registry.mask([384, 100, 999])  # 999: no such source, no bit
+    assert registry.decode(mask) == [100, 384]
+    assert registry.class_masks([(100, 199), (200, 399)]) == [
+        registry.mask([100]),
+        registry.mask([200, 300, 384]),
+    ]
+
+
+def test_route_table_merges_sorts_and_round_trips() -> None:
+    import io
+
+    table = prefix_updater.RouteTable()
+    table.extend([(0x0A000000, 8), (0x0A000000, 16)], 0b01)
+    table.add(0x01000000, 24, 0b10)
+    table.add(0x0A000000, 8, 0b10)  # duplicate: masks merge
+    assert list(table) == [(0x01000000, 24, 0b10), (0x0A000000, 8, 0b11), (0x0A000000, 16, 0b01)]
+    assert len(table) == 3
+
+    body = io.BytesIO()
+    table.dump(body)
+    data = body.getvalue()
+    assert list(prefix_updater.RouteTable.read(io.BytesIO(data), "routes")) == list(table)
+    with pytest.raises(ValueError):
+        prefix_updater.RouteTable.read(io.BytesIO(data[:-1]), "routes")
+
+
 def test_dedup_classes_idempotent() -> None:
-    routes = {
+    routes = _routes({
         "10.0.0.0/24": {300},
         "10.0.0.5/32": {200},
         "10.0.0.9/32": {384},
-    }
-    prefix_updater.dedup_covered_more_specifics(routes, classes=[(200, 399)])
-    assert (
-        prefix_updater.dedup_covered_more_specifics(routes, classes=[(200, 399)]) == 0
-    )
+    })
+    class_masks = _COMMUNITIES.class_masks([(200, 399)])
+    prefix_updater.dedup_covered_more_specifics(routes, class_masks=class_masks)
+    assert prefix_updater.dedup_covered_more_specifics(routes, class_masks=class_masks) == 0
 
 
 def test_filter_ranges_match_bird_conf() -> None:
@@ -783,3 +1303,790 @@ def test_filter_ranges_match_bird_conf() -> None:
         assert (int(m.group(1)), int(m.group(2))) == (lo, hi), (
             f"{name}: bird.conf {m.group(1)}..{m.group(2)} != FILTER_RANGES {lo}..{hi}"
         )
+
+
+def test_fetch_sources_keeps_url_order_and_caps_per_host(monkeypatch: Any) -> None:
+    import threading
+    import time
+
+    lock = threading.Lock()
+    in_flight: dict[str, int] = {}
+    peak: dict[str, int] = {}
+
+    def fake_download(resource: dict[str, Any], force_refresh: bool = False) -> list[str]:
+        host = prefix_updater._url_host(resource["url"])
+        with lock:
+            in_flight[host] = in_flight.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), in_flight[host])
+        # Later URLs finish first, so results arrive out of order.
+        time.sleep(0.05 if resource["url"].endswith("/1") else 0.01)
+        with lock:
+            in_flight[host] -= 1
+        return [resource["url"]]
+
+    monkeypatch.setattr(prefix_updater, "download_resource", fake_download)
+    sources = [
+        {"name": "a", "urls": [f"https://a.test/{n}" for n in range(1, 6)]},
+        {"name": "b", "url": "https://b.test/1"},
+        {"name": "c", "url": None},
+    ]
+
+    results = prefix_updater.fetch_sources(sources, workers=8, per_host=2)
+
+    assert [url for url, _ in results[0]] == [f"https://a.test/{n}" for n in range(1, 6)]
+    assert [res for _, res in results[0]] == [[f"https://a.test/{n}"] for n in range(1, 6)]
+    assert results[1] == [("https://b.test/1", ["https://b.test/1"])]
+    assert results[2] == []
+    assert peak["a.test"] == 2
+
+
+def test_download_resource_revalidates_expired_cache_with_304(
+    monkeypatch: Any, tmp_path: Path
+) -> None:
+    import json
+    import os
+    import urllib.error
+
+    monkeypatch.setattr(prefix_updater, "CACHE_DIR", str(tmp_path))
+    source = {"name": "blocked_ip", "url": "https://example.test/ip.lst", "format": "text"}
+    url_hash = prefix_updater.hashlib.sha256(source["url"].encode()).hexdigest()[:16]
+    cache_file = tmp_path / f"blocked_ip_{url_hash}.cache"
+    cache_file.write_text("192.0.2.1\n", encoding="utf-8")
+    (tmp_path / (cache_file.name + ".meta")).write_text(
+        json.dumps({"etag": '"v1"', "last_modified": "Mon, 01 Jan 2024 00:00:00 GMT"}),
+        encoding="utf-8",
+    )
+    expired = prefix_updater.time.time() - prefix_updater.CACHE_TTL - 60
+    os.utime(cache_file, (expired, expired))
+    sent: dict[str, Any] = {}
+
+    def fake_open(
+        url: str, headers: dict[str, str], timeout: float, pool: Any = None
+    ) -> Any:
+        sent.update(headers)
+        raise urllib.error.HTTPError(url, 304, "Not Modified", {}, None)  # type: ignore[arg-type]
+
+    monkeypatch.setattr(prefix_updater, "_http_open", fake_open)
+
+    assert list(prefix_updater.download_resource(source)) == ["192.0.2.1"]
+    assert sent["If-None-Match"] == '"v1"'
+    assert sent["If-Modified-Since"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+    # The TTL restarted on the reused body.
+    assert prefix_updater.time.time() - cache_file.stat().st_mtime < 60
+
+
+def test_download_resource_stores_validators_for_new_body(
+    monkeypatch: Any, tmp_path: Path
+) -> None:
+    import io
+    import json
+
+    monkeypatch.setattr(prefix_updater, "CACHE_DIR", str(tmp_path))
+    source = {"name": "blocked_ip", "url": "https://example.test/ip.lst", "format": "text"}
+
+    class FakeResponse(io.BytesIO):
+        headers = {"ETag": '"v2"'}
+
+    monkeypatch.setattr(
+        prefix_updater,
+        "_http_open",
+        lambda url, headers, timeout, pool=None: FakeResponse(b"198.51.100.0/24\n"),
+    )
+
+    assert list(prefix_updater.download_resource(source)) == ["198.51.100.0/24"]
+    (meta_file,) = tmp_path.glob("*.cache.meta")
+    assert json.loads(meta_file.read_text(encoding="utf-8")) == {
+        "etag": '"v2"',
+        "last_modified": None,
+    }
+
+
+def test_http_pool_closes_connection_on_unexpected_error() -> None:
+    import http.client
+
+    closed: list[bool] = []
+
+    class BrokenConnection:
+        sock = None
+
+        def request(self, *_args: Any, **_kwargs: Any) -> None:
+            pass
+
+        def getresponse(self) -> Any:
+            raise http.client.BadStatusLine("garbage")
+
+        def close(self) -> None:
+            closed.append(True)
+
+    pool = prefix_updater.HTTPPool()
+    pool._new_connection = lambda key, timeout: BrokenConnection()
+    with pytest.raises(http.client.BadStatusLine):
+        pool.open("http://example.test/list.txt", {}, timeout=1)
+    assert closed == [True]
+    assert not any(pool._idle.values())
+
+
+def test_http_pool_closes_connection_released_after_close() -> None:
+    closed: list[str] = []
+
+    class Done:
+        will_close = False
+
+        def isclosed(self) -> bool:
+            return True
+
+        def close(self) -> None:
+            closed.append("resp")
+
+    class Conn:
+        sock = object()
+
+        def close(self) -> None:
+            closed.append("conn")
+
+    key = ("https", "example.test", 443)
+    pool = prefix_updater.HTTPPool()
+    pool.release(key, Conn(), Done())  # type: ignore[arg-type]
+    assert len(pool._idle[key]) == 1 and closed == []
+
+    pool.close()
+    assert closed == ["conn"]
+    # A worker finishing its read after fetch_sources() closed the pool.
+    pool.release(key, Conn(), Done())  # type: ignore[arg-type]
+    assert closed == ["conn", "resp", "conn"]
+    assert not any(pool._idle.values())
+
+
+def test_http_pool_reuses_keepalive_connection_and_follows_redirects() -> None:
+    import http.server
+    import threading
+    import urllib.error
+
+    peers: set[int] = set()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            peers.add(self.client_address[1])
+            if self.path == "/old":
+                self.send_response(301)
+                self.send_header("Location", "/list")
+                self.send_header("Content-Length", "0")
+            elif self.path == "/list":
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = b"192.0.2.0/24\n"
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            else:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *_args: Any) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    pool = prefix_updater.HTTPPool()
+    try:
+        with pool.open(f"{base}/old", {}, timeout=5) as resp:
+            assert resp.read() == b"192.0.2.0/24\n"
+            assert resp.headers.get("ETag") == '"v1"'
+        with pytest.raises(urllib.error.HTTPError) as not_modified:
+            pool.open(f"{base}/list", {"If-None-Match": '"v1"'}, timeout=5)
+        assert not_modified.value.code == 304
+        with pytest.raises(urllib.error.HTTPError):
+            pool.open(f"{base}/missing", {}, timeout=5)
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+    # Redirect, 200, 304 and 404 all went over a single TCP connection.
+    assert len(peers) == 1
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "deflate", "raw-deflate", None])
+def test_download_resource_decompresses_negotiated_encoding(
+    monkeypatch: Any, tmp_path: Path, encoding: Any
+) -> None:
+    import gzip
+    import io
+    import zlib
+
+    body = b"203.0.113.0/24\n198.51.100.0/24\n"
+    if encoding == "gzip":
+        wire = gzip.compress(body)
+    elif encoding == "deflate":
+        wire = zlib.compress(body)
+    elif encoding == "raw-deflate":
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        wire = compressor.compress(body) + compressor.flush()
+        encoding = "deflate"
+    else:
+        wire = body
+    sent: dict[str, str] = {}
+
+    class FakeResponse(io.BytesIO):
+        headers = {"Content-Encoding": encoding} if encoding else {}
+
+    def fake_open(
+        url: str, headers: dict[str, str], timeout: float, pool: Any = None
+    ) -> Any:
+        sent.update(headers)
+        return FakeResponse(wire)
+
+    monkeypatch.setattr(prefix_updater, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(prefix_updater, "_http_open", fake_open)
+    source = {"name": "rkn_subnets", "url": "https://example.test/subnet.lst", "format": "text"}
+
+    assert list(prefix_updater.download_resource(source)) == ["203.0.113.0/24", "198.51.100.0/24"]
+    assert sent["Accept-Encoding"] == "gzip, deflate"
+    # The cache stores the decoded text, not the wire bytes.
+    (cache_file,) = tmp_path.glob("*.cache")
+    assert cache_file.read_bytes() == body
+
+
+def test_iter_ranges_normalizes_and_skips_invalid_items() -> None:
+    items = [
+        " 192.0.2.7 ",
+        "198.51.100.0/24",
+        "203.0.113.10 - 203.0.113.20",
+        "203.0.113.30-203.0.113.29",  # first > last
+        "1.2.3",
+        "1.2.3.4-5.6.7.8-9.9.9.9",
+        "",
+    ]
+    ip = prefix_updater.ip_to_int
+    assert list(prefix_updater.iter_ranges(items)) == [
+        (ip("192.0.2.7"), ip("192.0.2.7")),
+        (ip("198.51.100.0"), ip("198.51.100.255")),
+        (ip("203.0.113.10"), ip("203.0.113.20")),
+    ]
+
+
+def test_main_streams_text_source_from_cache(monkeypatch: Any, tmp_path: Path) -> None:
+    # A text source is consumed lazily from its cache file; ranges and bare
+    # IPs are normalized and collapsed like before.
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    url = "https://example.test/ip.lst"
+    url_hash = prefix_updater.hashlib.sha256(url.encode()).hexdigest()[:16]
+    (cache_dir / f"test_source_{url_hash}.cache").write_text(
+        "# comment\n192.0.2.0/25\n192.0.2.128-192.0.2.255\n198.51.100.7\nbogus\n",
+        encoding="utf-8",
+    )
+    bird_output = tmp_path / "prefixes.bird"
+    txt_output = tmp_path / "prefixes.txt"
+    own_file = tmp_path / "own-infra.lst"
+    own_file.write_text("203.0.113.0/24\n", encoding="utf-8")
+    monkeypatch.setattr(prefix_updater, "CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(prefix_updater, "OWN_INFRA_FILE", str(own_file))
+    monkeypatch.setattr(prefix_updater, "OWN_INFRA_CONF", str(own_file) + ".conf")
+    monkeypatch.setattr(prefix_updater, "OUTPUT_BIRD", str(bird_output))
+    monkeypatch.setattr(prefix_updater, "OUTPUT_TXT", str(txt_output))
+    monkeypatch.setattr(
+        prefix_updater,
+        "SOURCES",
+        [{"name": "test_source", "url": url, "community_suffix": 200, "format": "text"}],
+    )
+    monkeypatch.setattr(prefix_updater, "smoke_test_bird", lambda temp_bird_file: True)
+    monkeypatch.setattr(prefix_updater.subprocess, "run", completed_process)
+    monkeypatch.setattr(prefix_updater.sys, "argv", ["prefix_updater.py"])
+
+    prefix_updater.main()
+
+    assert txt_output.read_text(encoding="utf-8") == "192.0.2.0/24\n198.51.100.7/32"
+
+
+def test_collapse_source_reuses_ranges_cache_for_unchanged_bodies(
+    monkeypatch: Any, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(prefix_updater, "CACHE_DIR", str(tmp_path))
+    body_file = tmp_path / "aws_networks_0.cache"
+    body_file.write_text(
+        '{"prefixes": [{"ip_prefix": "3.10.17.128/25", "service": "CLOUDFRONT"},'
+        ' {"ip_prefix": "3.10.17.0/25", "service": "CLOUDFRONT"},'
+        ' {"ip_prefix": "52.95.245.0/24", "service": "AMAZON"}]}',
+        encoding="utf-8",
+    )
+    source = {"name": "aws_networks", "format": "aws_json", "aws_services": ["CLOUDFRONT"]}
+    ip = prefix_updater.ip_to_int
+    expected = [(ip("3.10.17.0"), ip("3.10.17.255"))]
+
+    def body(src: dict[str, Any]) -> Any:
+        return prefix_updater._CachedBody(str(body_file), src)
+
+    assert prefix_updater.collapse_source(source, [body(source)]) == expected
+    assert (tmp_path / "aws_networks.ranges").exists()
+
+    # Warm run: nothing is parsed or collapsed.
+    def no_parse(*_args: Any, **_kwargs: Any) -> Any:
+        raise AssertionError("ranges cache should have been used")
+
+    monkeypatch.setattr(prefix_updater, "_parse_json_file", no_parse)
+    monkeypatch.setattr(prefix_updater, "collapse_ranges", no_parse)
+    assert prefix_updater.collapse_source(source, [body(source)]) == expected
+
+    # Different parse options are a different key: parsed again.
+    amazon = dict(source, aws_services=["AMAZON"])
+    with pytest.raises(AssertionError):
+        prefix_updater.collapse_source(amazon, [body(amazon)])
+
+
+def test_fetch_sources_retries_without_blocking_healthy_sources(monkeypatch: Any) -> None:
+    calls: list[tuple[str, int]] = []
+
+    def fake_download(resource: dict[str, Any], force_refresh: bool = False) -> Any:
+        calls.append((resource["name"], resource["_attempt"]))
+        if resource["name"] == "flaky" and resource["_attempt"] == 1:
+            raise prefix_updater.RetryLater(0.2)
+        return [resource["name"]]
+
+    monkeypatch.setattr(prefix_updater, "download_resource", fake_download)
+    sources = [
+        {"name": "flaky", "url": "https://a.test/x"},
+        {"name": "healthy", "url": "https://b.test/y"},
+    ]
+
+    results = prefix_updater.fetch_sources(sources, workers=1)
+
+    # The single worker served the healthy source while the flaky one backed off.
+    assert calls == [("flaky", 1), ("healthy", 1), ("flaky", 2)]
+    assert results == [
+        [("https://a.test/x", ["flaky"])],
+        [("https://b.test/y", ["healthy"])],
+    ]
+
+
+def test_fetch_sources_deadline_resolves_unfinished_jobs_offline(monkeypatch: Any) -> None:
+    def fake_download(resource: dict[str, Any], force_refresh: bool = False) -> Any:
+        if resource["_offline"]:
+            return ["from-stale-cache"]
+        if resource["name"] == "dead":
+            raise prefix_updater.RetryLater(30)
+        return ["fresh"]
+
+    monkeypatch.setattr(prefix_updater, "download_resource", fake_download)
+    sources = [
+        {"name": "dead", "url": "https://a.test/x"},
+        {"name": "alive", "url": "https://b.test/y"},
+    ]
+    started = prefix_updater.time.time()
+
+    results = prefix_updater.fetch_sources(sources, deadline=started + 0.3)
+
+    assert prefix_updater.time.time() - started < 5
+    assert results == [
+        [("https://a.test/x", ["from-stale-cache"])],
+        [("https://b.test/y", ["fresh"])],
+    ]
+
+
+_TRICKLE_FETCH = """
+import http.server, importlib.util, sys, threading, time
+
+spec = importlib.util.spec_from_file_location("prefix_updater", sys.argv[1])
+pu = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(pu)
+pu.CACHE_DIR = sys.argv[2]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # /slow trickles its body over ~10s; /fast answers at once.
+        line, count = b"192.0.2.0/24\\n", 200 if self.path == "/slow" else 1
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(line) * count))
+        self.end_headers()
+        try:
+            for _ in range(count):
+                self.wfile.write(line)
+                self.wfile.flush()
+                if count > 1:
+                    time.sleep(0.05)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base = "http://127.0.0.1:%d" % server.server_address[1]
+started = time.time()
+results = CALL
+print("RESULTS", [[res is not None for _url, res in unit] for unit in results])
+print("RETURNED %.2f" % (time.time() - started))
+"""
+
+
+def _fetch_in_subprocess(tmp_path: Path, call: str) -> tuple[float, str]:
+    """Run fetch_sources() against a local trickling server in a fresh
+    interpreter; returns the wall-clock time until that process exited (the
+    interpreter joins executor threads at exit) and its stdout."""
+    import subprocess
+    import sys
+    import time
+
+    cache = tmp_path / "fetch-cache"
+    started = time.time()
+    proc = subprocess.run(
+        [sys.executable, "-c", _TRICKLE_FETCH.replace("CALL", call), str(MODULE_PATH), str(cache)],
+        capture_output=True, text=True, timeout=60,
+    )
+    assert proc.returncode == 0, proc.stderr
+    return time.time() - started, proc.stdout
+
+
+def test_fetch_sources_deadline_cancels_in_flight_download(tmp_path: Path) -> None:
+    elapsed, out = _fetch_in_subprocess(
+        tmp_path,
+        "pu.fetch_sources([{'name': 'slow', 'url': base + '/slow', 'format': 'text'}], "
+        "deadline=time.time() + 1.0)",
+    )
+
+    assert "RESULTS [[False]]" in out
+    # The process exits right after the deadline, not once the ~10s body ends,
+    # and the abandoned attempt left nothing in the cache.
+    assert elapsed < 5, out
+    assert not list((tmp_path / "fetch-cache").glob("slow_*"))
+
+
+def test_fetch_sources_cancels_losing_hedged_mirror(tmp_path: Path) -> None:
+    elapsed, out = _fetch_in_subprocess(
+        tmp_path,
+        "pu.fetch_sources([{'name': 'm', 'format': 'text', "
+        "'mirrors': [base + '/slow', base + '/fast']}], hedge_delay=0.05)",
+    )
+
+    assert "RESULTS [[True]]" in out
+    # The slow mirror stops once the fast one wins and caches nothing.
+    assert elapsed < 5, out
+    assert len(list((tmp_path / "fetch-cache").glob("m_*.cache"))) == 1
+
+
+def test_scheduled_download_attempt_defers_retry_then_uses_stale_cache(
+    monkeypatch: Any, tmp_path: Path
+) -> None:
+    import os
+
+    monkeypatch.setattr(prefix_updater, "CACHE_DIR", str(tmp_path))
+    source = {"name": "blocked_ip", "url": "https://example.test/ip.lst", "format": "text"}
+    url_hash = prefix_updater.hashlib.sha256(source["url"].encode()).hexdigest()[:16]
+    cache_file = tmp_path / f"blocked_ip_{url_hash}.cache"
+    cache_file.write_text("192.0.2.1\n", encoding="utf-8")
+    expired = prefix_updater.time.time() - prefix_updater.CACHE_TTL - 60
+    os.utime(cache_file, (expired, expired))
+
+    def failing_open(
+        url: str, headers: dict[str, str], timeout: float, pool: Any = None
+    ) -> Any:
+        raise OSError("connection refused")
+
+    def no_sleep(_delay: float) -> None:
+        raise AssertionError("scheduled attempts must not sleep")
+
+    monkeypatch.setattr(prefix_updater, "_http_open", failing_open)
+    monkeypatch.setattr(prefix_updater.time, "sleep", no_sleep)
+
+    with pytest.raises(prefix_updater.RetryLater) as retry:
+        prefix_updater.download_resource(dict(source, _attempt=1))
+    assert retry.value.delay == prefix_updater.RETRY_DELAY
+
+    last = dict(source, _attempt=prefix_updater.MAX_RETRIES)
+    assert list(prefix_updater.download_resource(last)) == ["192.0.2.1"]
+    assert list(prefix_updater.download_resource(dict(source, _offline=True))) == [
+        "192.0.2.1"
+    ]
+
+
+def test_gc_cache_removes_orphans_and_evicts_lru_over_budget(
+    monkeypatch: Any, tmp_path: Path
+) -> None:
+    import os
+    import time
+
+    monkeypatch.setattr(prefix_updater, "CACHE_DIR", str(tmp_path))
+    sources = [
+        {"name": "a", "url": "https://example.com/a.txt"},
+        {"name": "b", "url": "https://example.com/b.txt"},
+    ]
+    a_body = Path(prefix_updater._cache_path("a", "https://example.com/a.txt"))
+    b_body = Path(prefix_updater._cache_path("b", "https://example.com/b.txt"))
+    for path in (a_body, b_body):
+        path.write_bytes(b"x" * 1000)
+    a_meta = Path(str(a_body) + ".meta")
+    a_meta.write_text("{}", encoding="utf-8")
+    old_url = Path(prefix_updater._cache_path("a", "https://example.com/old.txt"))
+    old_url.write_text("1.0.0.0/24\n", encoding="utf-8")
+    renamed = tmp_path / "gone.ranges"
+    renamed.write_bytes(b"")
+    stale_tmp = tmp_path / "a_1234.cache.tmp"
+    stale_tmp.write_bytes(b"")
+    os.utime(stale_tmp, (time.time() - 7200, time.time() - 7200))
+    foreign = tmp_path / "notes.json"
+    foreign.write_text("{}", encoding="utf-8")
+    # "a" was used long ago, "b" just now.
+    os.utime(a_body, (time.time() - 86400, time.time()))
+
+    prefix_updater.gc_cache(sources, max_bytes=1500)
+
+    assert not old_url.exists() and not renamed.exists() and not stale_tmp.exists()
+    assert not a_body.exists() and not a_meta.exists()
+    assert b_body.exists() and foreign.exists()
+
+
+def test_compressed_cache_round_trips_and_keeps_ttl_clock(
+    monkeypatch: Any, tmp_path: Path
+) -> None:
+    import io
+    import os
+
+    monkeypatch.setattr(prefix_updater, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(prefix_updater, "CACHE_COMPRESS", True)
+    body = b"# comment\n1.0.0.0/24\n\n2.0.0.0/24\n"
+
+    class FakeResponse(io.BytesIO):
+        headers: dict[str, str] = {}
+
+    monkeypatch.setattr(prefix_updater, "_http_open", lambda *a, **k: FakeResponse(body))
+    source = {"name": "txt", "url": "https://example.com/list.txt", "format": "text"}
+    assert list(prefix_updater.download_resource(source)) == ["1.0.0.0/24", "2.0.0.0/24"]
+
+    cache_path = prefix_updater._cache_path("txt", source["url"])
+    with open(cache_path, "rb") as f:
+        assert f.read(2) == b"\x1f\x8b"
+    mtime = os.path.getmtime(cache_path)
+
+    def offline(*_args: Any, **_kwargs: Any) -> Any:
+        raise AssertionError("fresh cache should not be refetched")
+
+    monkeypatch.setattr(prefix_updater, "_http_open", offline)
+    assert list(prefix_updater.download_resource(source)) == ["1.0.0.0/24", "2.0.0.0/24"]
+    assert os.path.getmtime(cache_path) == mtime
+
+
+def test_fetch_sources_circuit_breaker_skips_dead_source_then_probes_once(
+    monkeypatch: Any,
+) -> None:
+    import time
+
+    calls: list[tuple[str, int, Any]] = []
+
+    def fake_download(resource: dict[str, Any], force_refresh: bool = False) -> Any:
+        calls.append((resource["name"], resource["_attempt"], resource["_offline"]))
+        if resource["name"] == "dead" and not resource["_offline"]:
+            resource["_outcome"] = "failed"
+            return None
+        return ["192.0.2.0/24"]
+
+    monkeypatch.setattr(prefix_updater, "download_resource", fake_download)
+    monkeypatch.setattr(prefix_updater, "BREAKER_THRESHOLD", 2)
+    monkeypatch.setattr(prefix_updater, "BREAKER_COOLDOWN", 3600)
+    sources = [
+        {"name": "dead", "url": "https://dead.example/a.txt"},
+        {"name": "alive", "url": "https://alive.example/a.txt"},
+    ]
+    health = {"dead": {"consecutive_failures": 2, "last_failure": time.time() - 60}}
+
+    results = prefix_updater.fetch_sources(sources, health=health)
+
+    # Open breaker: resolved offline (cache/FALLBACK) without a download.
+    assert ("dead", 1, "circuit breaker open") in calls
+    assert all(not offline for name, _, offline in calls if name == "alive")
+    assert results[1] == [("https://alive.example/a.txt", ["192.0.2.0/24"])]
+    assert health["dead"]["consecutive_failures"] == 2  # skipped runs don't count
+    assert health["alive"]["consecutive_failures"] == 0
+    assert health["alive"]["last_success"] > 0
+    assert len(health["alive"]["latency"]) == 1
+
+    # Cool-down over: a single probe attempt, whose failure re-opens it.
+    health["dead"]["last_failure"] = time.time() - 7200
+    calls.clear()
+    prefix_updater.fetch_sources(sources, health=health)
+    assert [c for c in calls if c[0] == "dead"] == [("dead", prefix_updater.MAX_RETRIES, False)]
+    assert health["dead"]["consecutive_failures"] == 3
+    assert prefix_updater.breaker_state(health["dead"], time.time()) == "open"
+
+
+def test_source_health_round_trips_and_drops_removed_sources() -> None:
+    health = {
+        "kept": {"consecutive_failures": 1, "latency": [0.5, 1.5]},
+        "removed": {"consecutive_failures": 4},
+    }
+    prefix_updater.save_health(health, [{"name": "kept"}])
+    loaded = prefix_updater.load_health()
+    assert loaded == {"kept": {"consecutive_failures": 1, "latency": [0.5, 1.5]}}
+    assert prefix_updater.mean_latency(loaded["kept"]) == 1.0
+
+
+def test_fetch_sources_hedges_slow_mirror_and_keeps_union_urls(monkeypatch: Any) -> None:
+    import threading
+    import time
+
+    release = threading.Event()
+    calls: list[str] = []
+
+    def fake_download(resource: dict[str, Any], force_refresh: bool = False) -> Any:
+        calls.append(resource["url"])
+        if resource["url"] == "https://slow.example/list.txt":
+            release.wait(5)
+        return [resource["url"]]
+
+    monkeypatch.setattr(prefix_updater, "download_resource", fake_download)
+    sources = [
+        {
+            "name": "mirrored",
+            "mirrors": ["https://slow.example/list.txt", "https://fast.example/list.txt"],
+        },
+        {"name": "union", "urls": ["https://a.example/1.txt", "https://b.example/2.txt"]},
+    ]
+
+    started = time.time()
+    try:
+        results = prefix_updater.fetch_sources(sources, hedge_delay=0.05)
+    finally:
+        release.set()
+
+    assert time.time() - started < 2
+    assert results[0] == [("https://fast.example/list.txt", ["https://fast.example/list.txt"])]
+    assert results[1] == [
+        ("https://a.example/1.txt", ["https://a.example/1.txt"]),
+        ("https://b.example/2.txt", ["https://b.example/2.txt"]),
+    ]
+
+
+def test_fetch_sources_mirror_failover_without_waiting_for_hedge(monkeypatch: Any) -> None:
+    calls: list[str] = []
+
+    def fake_download(resource: dict[str, Any], force_refresh: bool = False) -> Any:
+        calls.append(resource["url"])
+        if resource["url"] == "https://down.example/list.txt":
+            resource["_outcome"] = "failed"
+            return ["stale"]  # stale cache stood in
+        return ["fresh"]
+
+    monkeypatch.setattr(prefix_updater, "download_resource", fake_download)
+    healthy = {"name": "m", "mirrors": ["https://up.example/list.txt", "https://down.example/list.txt"]}
+    assert prefix_updater.fetch_sources([healthy], hedge_delay=60) == [
+        [("https://up.example/list.txt", ["fresh"])]
+    ]
+    assert calls == ["https://up.example/list.txt"]
+
+    calls.clear()
+    failing = {"name": "m", "mirrors": ["https://down.example/list.txt", "https://up.example/list.txt"]}
+    assert prefix_updater.fetch_sources([failing], hedge_delay=60) == [
+        [("https://up.example/list.txt", ["fresh"])]
+    ]
+    assert calls == ["https://down.example/list.txt", "https://up.example/list.txt"]
+
+
+def test_main_short_circuits_when_inputs_match_last_publish(
+    monkeypatch: Any, tmp_path: Path
+) -> None:
+    src_file = tmp_path / "list.txt"
+    src_file.write_text("192.0.2.0/24\n", encoding="utf-8")
+    own_file = tmp_path / "own-infra.lst"
+    own_file.write_text("203.0.113.0/24\n", encoding="utf-8")
+    bird_output = tmp_path / "prefixes.bird"
+    monkeypatch.setattr(prefix_updater, "OWN_INFRA_FILE", str(own_file))
+    monkeypatch.setattr(prefix_updater, "OWN_INFRA_CONF", str(own_file) + ".conf")
+    monkeypatch.setattr(prefix_updater, "OUTPUT_BIRD", str(bird_output))
+    monkeypatch.setattr(prefix_updater, "OUTPUT_TXT", str(tmp_path / "prefixes.txt"))
+    monkeypatch.setattr(
+        prefix_updater,
+        "SOURCES",
+        [{"name": "local", "url": str(src_file), "community_suffix": 200, "format": "text"}],
+    )
+    monkeypatch.setattr(prefix_updater, "smoke_test_bird", lambda temp_bird_file: True)
+    monkeypatch.setattr(prefix_updater.subprocess, "run", completed_process)
+    peers_dir = tmp_path / "peers.d"
+    peers_dir.mkdir()
+    monkeypatch.setattr(
+        prefix_updater.sys, "argv", ["prefix_updater.py", "--peers-dir", str(peers_dir)]
+    )
+
+    prefix_updater.main()
+    assert "192.0.2.0/24" in bird_output.read_text(encoding="utf-8")
+
+    collapsed: list[str] = []
+    real_collapse = prefix_updater.collapse_source
+
+    def tracking_collapse(source: Any, bodies: Any, store: bool = True) -> Any:
+        collapsed.append(source["name"])
+        return real_collapse(source, bodies, store)
+
+    monkeypatch.setattr(prefix_updater, "collapse_source", tracking_collapse)
+    prefix_updater.main()
+    assert collapsed == []  # nothing changed: no parsing, no rendering
+
+    # Any input change (here own-infra) runs the pipeline again.
+    own_file.write_text("203.0.113.0/24\n198.51.100.0/24\n", encoding="utf-8")
+    prefix_updater.main()
+    assert collapsed == ["local"]
+
+    # So does a feed that no longer matches what was published.
+    collapsed.clear()
+    bird_output.write_text("", encoding="utf-8")
+    prefix_updater.main()
+    assert collapsed == ["local"]
+    assert "192.0.2.0/24" in bird_output.read_text(encoding="utf-8")
+
+
+def test_range_to_prefixes_matches_ipaddress_summarize() -> None:
+    import random
+
+    rng = random.Random(14)
+    cases = [(0, 2**32 - 1), (0, 0), (2**32 - 1, 2**32 - 1), (1, 2**32 - 2), (5, 1000)]
+    for _ in range(2000):
+        start = rng.randrange(0, 2**32)
+        cases.append((start, min(2**32 - 1, start + rng.randrange(0, 2 ** rng.randrange(1, 33)))))
+    for start, end in cases:
+        expected = [
+            (int(n.network_address), n.prefixlen)
+            for n in ipaddress.summarize_address_range(
+                ipaddress.IPv4Address(start), ipaddress.IPv4Address(end)
+            )
+        ]
+        assert prefix_updater.range_to_prefixes(start, end) == expected
+        assert prefix_updater.range_to_cidrs(start, end) == [
+            f"{ipaddress.IPv4Address(n)}/{p}" for n, p in expected
+        ]
+    with pytest.raises(ValueError):
+        prefix_updater.range_to_prefixes(10, 9)
+
+
+def test_numpy_engine_matches_pure_python(monkeypatch: Any) -> None:
+    pytest.importorskip("numpy")
+    import random
+
+    rng = random.Random(13)
+    samples = [
+        [(0, 2**32 - 1)],
+        [(0, 0), (1, 2**32 - 2), (2**32 - 1, 2**32 - 1)],
+        [
+            (start, min(2**32 - 1, start + rng.choice([0, 1, 255, 4095, 70000])))
+            for start in (rng.randrange(0, 2**32) for _ in range(5000))
+        ],
+    ]
+    for ranges in samples:
+        monkeypatch.setattr(prefix_updater, "NUMPY_MIN_RANGES", 10**9)
+        collapsed = prefix_updater.collapse_ranges(ranges)
+        cidrs = prefix_updater.ranges_to_cidrs(collapsed)
+        monkeypatch.setattr(prefix_updater, "NUMPY_MIN_RANGES", 1)
+        assert prefix_updater.collapse_ranges(ranges) == collapsed
+        assert prefix_updater.ranges_to_cidrs(collapsed) == cidrs